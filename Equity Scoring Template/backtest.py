@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from utils_frames import compact_frame, concat_frames, TickerPool
+from utils_general import create_universe, get_raw_data, run_in_parallel
+from utils_scoring import select_top_bottom, total_score
+
+
+class Backtest(object):
+
+    def __init__(self, factors, connection, universe_ticker, dates, weights=None, currency='EUR', min_mktcap=0, max_mktcap=10000000,
+                 sector='All', countries=None, rank_num=50, max_workers=4, request_timeout=None, store=None, compact=False, float32=False):
+        '''
+        Summary:
+            Runs the scoring model of the app over a list of rebalance dates, without any widget.
+            For each date, one request retrieves the members (with the same filters as the app), the raw
+            values of the factors and the forward return until the next date; the scores are computed locally.
+        Args:
+            factors (AllFactors): the factors of the model.
+            connection (bq connection): a connection to the bql server initialised with bql.Service().
+            universe_ticker (str): the ticker of the index, e.g. 'SXXP Index'.
+            dates (list): the rebalance dates, in increasing order (e.g. month ends as 'YYYY-MM-DD').
+            weights (dict or Series): the Total Score weights in percent, mapped by factor name. Defaults to equal weights.
+            currency (str): the currency of the data.
+            min_mktcap (int): the minimum market cap in millions.
+            max_mktcap (int): the maximum market cap in millions.
+            sector (str): a GICS sector name, or 'All'.
+            countries (list): the upper case country names to be kept, or None for all.
+            rank_num (int): the number of stocks in the top and bottom portfolios.
+            max_workers (int): the number of dates requested concurrently.
+            request_timeout (float): the maximum number of seconds to wait for all the dates.
+            store (SnapshotStore): if given, the responses are kept on disk and reused by later runs.
+            compact (bool): if True, the scores of each date are stored compactly (categorical text columns, interned
+                tickers, see utils_frames), and the panels are dictionary encoded, for many dates of large universes.
+            float32 (bool): with compact, the scores are stored as float32.
+        '''
+        if float32 and not compact:
+            raise ValueError('float32 only applies with compact=True')
+        self.factors = factors
+        self.connection = connection
+        self.universe_ticker = universe_ticker
+        self.dates = [str(date) for date in dates]
+        total_score_factors = factors.total_score_factors
+        if weights is None:
+            weights = pd.Series(100. / max(len(total_score_factors), 1), index=total_score_factors)
+        # as ScoringEngine.weights: the factors without a weight get 0
+        self.weights = pd.Series(weights, dtype=float).reindex(total_score_factors).fillna(0.)
+        self.currency = currency
+        self.min_mktcap = min_mktcap
+        self.max_mktcap = max_mktcap
+        self.sector = sector
+        self.countries = countries
+        self.rank_num = rank_num
+        self.max_workers = max_workers
+        self.request_timeout = request_timeout
+        self.store = store
+        self.compact = compact
+        self.float32 = float32
+        self.tickers = TickerPool()
+        self.results = OrderedDict()
+
+    def forward_return(self, date, next_date):
+        return self.connection.data.px_last(dates=self.connection.func.range(date, next_date), CA_ADJ='FULL', fill='prev').pct_chg()
+
+    def raw_fields(self, date, next_date=None):
+        fields = self.factors.raw_fields(date, all_factors=True)
+        if next_date is not None:
+            fields['Forward Return'] = self.forward_return(date, next_date)
+        return fields
+
+    def score_date(self, date, next_date=None):
+        ''' Returns the factor scores, the Total Score and the forward return of the members at the date.'''
+        universe = create_universe(
+            connection=self.connection, universe_ticker=self.universe_ticker, ref_date=date, min_mktcap=self.min_mktcap,
+            max_mktcap=self.max_mktcap, sector=self.sector, countries=self.countries, point_in_time=True,
+        )
+        store = None if self.store is None else self.store.partition(date, self.universe_ticker, self.currency)
+        raw_data = get_raw_data(
+            connection=self.connection, universe=universe, fields=self.raw_fields(date, next_date),
+            with_params={'currency': self.currency, 'fill': 'prev', 'mode': 'cached'}, store=store,
+        )
+        data = self.factors.compute_local(raw_data)
+        if len(self.weights) > 0:
+            data = data.join(total_score(data, self.weights))
+        data['Forward Return'] = raw_data['Forward Return'] if next_date is not None else np.nan
+        if self.compact:
+            data = compact_frame(data, float32=self.float32, pool=self.tickers)
+        return data
+
+    def run(self):
+        ''' Scores all dates (concurrently) and returns the long format panel of scores.'''
+        next_dates = self.dates[1:] + [None]
+        tasks = [partial(self.score_date, date, next_date) for date, next_date in zip(self.dates, next_dates)]
+        results = run_in_parallel(tasks, max_workers=self.max_workers, timeout=self.request_timeout)
+        self.results = OrderedDict(zip(self.dates, results))
+        return self.panel
+
+    @property
+    def scores(self):
+        ''' The scores of all dates in wide format, indexed by (date, ID), with the dates, tickers and text columns dictionary encoded.'''
+        return concat_frames(self.results, float32=self.compact and self.float32)
+
+    @property
+    def score_columns(self):
+        ''' The scores of the factors used in the Total Score, and the Total Score.'''
+        columns = self.factors.total_score_factors
+        return columns + ['Total Score'] if len(self.weights) > 0 else columns
+
+    @property
+    def panel(self):
+        ''' The scores (see score_columns) in long format, with columns date, ticker, factor and score.'''
+        frames = []
+        for date, data in self.results.items():
+            scores = data[self.score_columns]
+            scores = scores.rename_axis(index='ticker', columns='factor').stack().rename('score').reset_index()
+            scores.insert(0, 'date', date)
+            frames.append(scores)
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['date', 'ticker', 'factor', 'score'])
+        panel = pd.concat(frames, ignore_index=True)
+        if self.compact:
+            panel = compact_frame(panel, float32=self.float32)
+        return panel
+
+    def portfolio(self, date, rank_method='Top'):
+        ''' The IDs of the Top or Bottom rank_num names by Total Score at the date (names missing a factor score are not ranked).'''
+        if len(self.weights) == 0:
+            raise ValueError('The portfolios are built from the Total Score: no factor is used in the Total Score')
+        data = self.results[str(date)]
+        score = data['Total Score'].where(data[self.weights.index.tolist()].notnull().all(axis=1))
+        return data.index[select_top_bottom(score, rank_method, self.rank_num).values]
+
+    @property
+    def portfolio_returns(self):
+        ''' The equally weighted forward returns of the Top and Bottom rank_num names and of the whole universe, by date.'''
+        returns = []
+        for date, data in self.results.items():
+            forward_return = data['Forward Return']
+            returns.append([
+                forward_return[self.portfolio(date, 'Top')].mean(),
+                forward_return[self.portfolio(date, 'Bottom')].mean(),
+                forward_return.mean(),
+            ])
+        returns = pd.DataFrame(returns, index=list(self.results.keys()), columns=['Top', 'Bottom', 'Universe'], dtype=float)
+        returns['Top - Bottom'] = returns['Top'] - returns['Bottom']
+        return returns.dropna(how='all')
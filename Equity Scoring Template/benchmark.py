@@ -0,0 +1,244 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import utils_fake_bql
+utils_fake_bql.install()
+
+from scoring_engine import ScoringEngine, ScoringParameters
+from utils_cache import CachedConnection
+from utils_factors import AllFactors, DescriptiveFactor, RankedFactor, ZScoreFactor
+
+
+# Benchmarks of the scoring code against the synthetic bql service of utils_fake_bql.
+# Each scenario scores one screen with every mode of the engine and reports the wall time,
+# the number of requests, the bytes returned by the service and the peak Python memory:
+#
+#     python benchmark.py --output results.json
+#     python benchmark.py --scenarios universe_size --latency 0.2 --baseline results.json
+#
+# With --imports, the time to import each module in a new Python process is measured instead,
+# with the heavy modules (bql, widgets, pandas) it loaded.
+
+FIELDS = ['px_last', 'eps', 'roe', 'roa', 'is_div_per_shr', 'ev_to_ebitda', 'sales_rev_turn', 'cf_free_cash_flow',
+          'tot_debt_to_tot_eqy', 'px_to_book_ratio', 'best_eps', 'best_sales']
+
+MODES = OrderedDict([
+    ('server', {}),
+    ('parallel_batched', {'max_workers': 4, 'batch_requests': True}),
+    ('local', {'local_scoring': True}),
+    ('local_filters', {'local_scoring': True, 'local_filters': True}),
+])
+
+SCENARIOS = OrderedDict([
+    ('universe_size', [{'universe_size': size} for size in [50, 500, 2000, 5000, 20000]]),
+    ('factor_count', [{'factor_count': count} for count in [1, 3, 6, 12]]),
+    ('functions_per_factor', [{'functions_per_factor': count} for count in [1, 3, 6, 12]]),
+    ('refreshes', [{'refreshes': count} for count in [1, 5, 20]]),
+])
+
+IMPORTS = ['utils_factors', 'utils_scoring', 'utils_general', 'scoring_engine', 'backtest', 'daily_refresh', 'utils_gui', 'equity_scoring']
+
+HEAVY_MODULES = ['bql', 'ipywidgets', 'bqwidgets', 'pandas', 'numpy']
+
+IMPORT_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+print(json.dumps([duration, [name for name in {heavy!r} if name in sys.modules]]))
+'''
+
+DEFAULTS = OrderedDict([('universe_size', 2000), ('factor_count', 3), ('functions_per_factor', 3), ('refreshes', 1)])
+
+
+def build_factors(connection, factor_count=3, functions_per_factor=3):
+    ''' A model like the one of the notebook: descriptive fields, then factor_count factors (alternating
+    z-score and ranked) of functions_per_factor functions each, all used in the Total Score.'''
+    descriptive_fields = DescriptiveFactor('Descriptive Fields', use_in_total_score=False)
+    descriptive_fields.add_factor(name='Name', bql_function=connection.data.name())
+    descriptive_fields.add_factor(name='Sector', bql_function=connection.data.gics_sector_name())
+    descriptive_fields.add_factor(name='Country', bql_function=connection.data.country_full_name())
+    factors = [descriptive_fields]
+    for i in range(factor_count):
+        factor = ZScoreFactor('Factor {}'.format(i)) if i % 2 == 0 else RankedFactor('Factor {}'.format(i))
+        for j in range(functions_per_factor):
+            field = FIELDS[(i * functions_per_factor + j) % len(FIELDS)]
+            bql_function = getattr(connection.data, field)(FPO=str(i), FPT='A')
+            factor.add_factor(name='{} {}'.format(field, i), bql_function=bql_function, sign=1 if j % 2 == 0 else -1)
+        factors.append(factor)
+    return AllFactors(factors, total_score_position=1)
+
+
+def measure(function, service, repeat=1):
+    '''
+    Summary:
+        Calls function repeat times and returns the best wall time, then calls it once more under tracemalloc
+        for the peak memory. The request count and the bytes moved are those of the timed calls, per call.
+    Args:
+        function (function): the function to be measured, without arguments.
+        service (utils_fake_bql.Service): the service whose counters are read.
+        repeat (int): the number of timed calls.
+    '''
+    service.reset_counters()
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        wall_times.append(time.perf_counter() - start)
+    request_count, bytes_moved = service.request_count / repeat, service.bytes_moved / repeat
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([
+        ('wall_time', min(wall_times)), ('request_count', request_count), ('bytes_moved', bytes_moved), ('peak_memory', peak_memory),
+    ])
+
+
+def run_case(mode, universe_size, factor_count, functions_per_factor, refreshes, latency=0., latency_per_row=0., repeat=1):
+    ''' Scores one screen refreshes times with a fresh engine and cache, and returns the measures.'''
+    service = utils_fake_bql.Service(universe_size=universe_size, latency=latency, latency_per_row=latency_per_row)
+    params = ScoringParameters(universe_ticker='SXXP Index', ref_date='2020-01-31')
+
+    def score():
+        connection = CachedConnection(service)
+        engine = ScoringEngine(build_factors(connection, factor_count, functions_per_factor), connection, **MODES[mode])
+        for _ in range(refreshes):
+            engine.score(params)
+
+    return measure(score, service, repeat=repeat)
+
+
+def run_benchmarks(scenarios=None, modes=None, latency=0., latency_per_row=0., repeat=1, verbose=True):
+    ''' Runs the given scenarios (defaults to all of them) for the given modes and returns the list of results.'''
+    if scenarios is None:
+        scenarios = list(SCENARIOS.keys())
+    if modes is None:
+        modes = list(MODES.keys())
+    results = []
+    for scenario in scenarios:
+        for case in SCENARIOS[scenario]:
+            for mode in modes:
+                values = OrderedDict(DEFAULTS)
+                values.update(case)
+                result = OrderedDict([('scenario', scenario), ('mode', mode)])
+                result.update(values)
+                result.update(run_case(mode, latency=latency, latency_per_row=latency_per_row, repeat=repeat, **values))
+                results.append(result)
+                if verbose:
+                    print(format_result(result))
+    return results
+
+
+def measure_import(module, repeat=5):
+    '''
+    Summary:
+        Imports the module in repeat new Python processes (the real bql service and widgets are used if installed)
+        and returns the best import time, without the start of the interpreter, and the heavy modules loaded.
+    '''
+    code = IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    durations, loaded, error = [], [], None
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', code], cwd=folder, capture_output=True, text=True)
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()[-1]
+            break
+        duration, loaded = json.loads(process.stdout.strip().splitlines()[-1])
+        durations.append(duration)
+    return OrderedDict([
+        ('module', module), ('import_time', min(durations) if len(durations) > 0 else None), ('loaded', loaded), ('error', error),
+    ])
+
+
+def run_import_benchmarks(modules=None, repeat=5, verbose=True):
+    ''' Measures the import time of the given modules (defaults to IMPORTS) and returns the list of results.'''
+    results = []
+    for module in modules if modules is not None else IMPORTS:
+        result = measure_import(module, repeat=repeat)
+        results.append(result)
+        if verbose:
+            print(format_import_result(result))
+    return results
+
+
+def format_import_result(result, baseline=None):
+    if result['error'] is not None:
+        return '{module:<17} failed: {error}'.format(**result)
+    text = '{:<17} {:8.1f} ms  loads: {}'.format(result['module'], result['import_time'] * 1000, ', '.join(result['loaded']) or '-')
+    if baseline is not None and baseline.get('import_time') is not None:
+        text += '  x{:.2f} time'.format(result['import_time'] / max(baseline['import_time'], 1e-9))
+    return text
+
+
+def result_key(result):
+    return (result['scenario'], result['mode']) + tuple(result[name] for name in DEFAULTS.keys())
+
+
+def format_result(result, baseline=None):
+    text = '{scenario:<21} {mode:<17} n={universe_size:<6} f={factor_count:<3} fn={functions_per_factor:<3} r={refreshes:<3}' \
+           '{wall_time:9.3f}s {request_count:7.1f} req {bytes_moved:12,.0f} B {peak_memory:12,.0f} B peak'.format(**result)
+    if baseline is not None:
+        text += '  x{:.2f} time, x{:.2f} bytes'.format(
+            result['wall_time'] / max(baseline['wall_time'], 1e-9), result['bytes_moved'] / max(baseline['bytes_moved'], 1.))
+    return text
+
+
+def write_report(path, results, **settings):
+    ''' Writes the results to a JSON file, with the date, the Python version, the platform and the given settings.'''
+    report = OrderedDict([
+        ('date', datetime.datetime.now().isoformat(timespec='seconds')),
+        ('python', sys.version.split()[0]),
+        ('platform', platform.platform()),
+    ])
+    report.update(sorted(settings.items()))
+    report['results'] = results
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the scoring engine against a synthetic bql service.')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS.keys()), default=None, help='Defaults to all scenarios.')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES.keys()), default=None, help='Defaults to all modes.')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds slept by the service for every request.')
+    parser.add_argument('--latency-per-row', type=float, default=0., help='Additional seconds slept per row and field returned.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of timed runs of each case (the best one is kept).')
+    parser.add_argument('--output', default=None, help='JSON file where the results are written.')
+    parser.add_argument('--baseline', default=None, help='JSON file of previous results, to compare with.')
+    parser.add_argument('--imports', action='store_true', help='Measure the import time of the modules instead (see IMPORTS).')
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        results = run_import_benchmarks(repeat=max(args.repeat, 5), verbose=args.baseline is None)
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = {result['module']: result for result in json.load(f)['results']}
+            for result in results:
+                print(format_import_result(result, baseline.get(result['module'])))
+        if args.output is not None:
+            write_report(args.output, results)
+        return
+
+    results = run_benchmarks(args.scenarios, args.modes, args.latency, args.latency_per_row, args.repeat, verbose=args.baseline is None)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = {result_key(result): result for result in json.load(f)['results']}
+        for result in results:
+            print(format_result(result, baseline.get(result_key(result))))
+    if args.output is not None:
+        write_report(args.output, results, latency=args.latency, latency_per_row=args.latency_per_row)
+
+
+if __name__ == '__main__':
+    main()
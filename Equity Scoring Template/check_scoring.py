@@ -0,0 +1,189 @@
+import argparse
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import utils_fake_bql
+utils_fake_bql.install()
+
+from backtest import Backtest
+from scoring_engine import ScoringEngine, ScoringParameters
+from utils_factors import AllFactors, DescriptiveFactor, LocalExpression, RankedFactor, ZScoreFactor
+from utils_scoring import group_codes, group_rank_max, group_winsorize, group_zscore, neutral_rank, neutral_zscore, screen_total_score, weighted_zscore
+
+
+# Regression checks of the local scoring, against the synthetic bql service of utils_fake_bql:
+# the scores of ScoringEngine(local_scoring=True) are compared with those of the bql server path, and the
+# grouped (sector/country-neutral) functions of utils_scoring with a pandas groupby reference, and the portfolios
+# of a Backtest with the screen of the app (screen_total_score).
+# The data include missing values, ties and divisions by zero. The script exits with status 1 if a check fails:
+#
+#     python check_scoring.py
+#     python check_scoring.py --universe-size 2000 --nan-ratio 0.3
+
+
+def build_factors(connection):
+    ''' A model with ties (0/1 flags), missing values, divisions by zero and operands shared by several inputs.'''
+    descriptive_fields = DescriptiveFactor('Descriptive Fields', use_in_total_score=False)
+    descriptive_fields.add_factor(name='Name', bql_function=connection.data.name())
+    descriptive_fields.add_factor(name='Sector', bql_function=connection.data.gics_sector_name())
+    value = ZScoreFactor('Value', use_in_total_score=True)
+    value.add_factor(name='Earnings Yield', bql_function=connection.data.eps() / connection.data.px_last() * 100)
+    value.add_factor(name='Price to Book', bql_function=connection.data.px_to_book_ratio(), sign=-1)
+    value.add_factor(name='High ROE', bql_function=(connection.data.roe() > 1) + connection.data.roa() * 0, relative_weight=2.)
+    value.add_factor(name='EPS if High ROE', bql_function=connection.data.eps() / (connection.data.roe() > 1))
+    quality = RankedFactor('Quality', use_in_total_score=True)
+    quality.add_factor(name='ROA', bql_function=connection.data.roa())
+    quality.add_factor(name='Low Debt', bql_function=(connection.data.tot_debt_to_tot_eqy() < 1) + connection.data.eps() * 0)
+    quality.add_factor(name='Sales to Price', bql_function=connection.data.sales_rev_turn() / connection.data.px_last(), sign=-1, relative_weight=0.5)
+    return AllFactors([descriptive_fields, value, quality], total_score_position=1)
+
+
+def compare_frames(expected, actual, tolerance=1e-9):
+    ''' The differences between two scored DataFrames (rows, columns, then values column by column), as a list of messages.'''
+    if set(expected.index) != set(actual.index):
+        return ['{} rows expected, {} found, {} in common'.format(len(expected), len(actual), len(set(expected.index) & set(actual.index)))]
+    if list(expected.columns) != list(actual.columns):
+        return ['columns {} expected, {} found'.format(list(expected.columns), list(actual.columns))]
+    actual = actual.reindex(expected.index)
+    differences = []
+    for column in expected.columns:
+        if pd.api.types.is_numeric_dtype(expected[column]):
+            left, right = expected[column].values.astype(float), actual[column].values.astype(float)
+            same = np.isclose(left, right, rtol=tolerance, atol=tolerance, equal_nan=True)
+        else:
+            left, right = expected[column].values, actual[column].values
+            same = (left == right) | (pd.isnull(left) & pd.isnull(right))
+        if not same.all():
+            differences.append('{}: {} of {} values differ'.format(column, int((~same).sum()), len(same)))
+    return differences
+
+
+def check_engine(universe_size=500, nan_ratio=0.2):
+    ''' The scores of the local scoring against those of the bql server path, for the whole universe.'''
+    connection = utils_fake_bql.Service(universe_size=universe_size, nan_ratio=nan_ratio)
+    params = ScoringParameters(universe_ticker='SXXP Index', ref_date='2020-01-31', rank_num=universe_size)
+    server = ScoringEngine(build_factors(connection), connection).score(params)
+    local = ScoringEngine(build_factors(connection), connection, local_scoring=True).score(params)
+    return compare_frames(server, local)
+
+
+def check_backtest(universe_size=500, nan_ratio=0.2, rank_num=20):
+    ''' The Top/Bottom portfolios of a Backtest (weights given as a dict) against screen_total_score, with their returns.'''
+    connection = utils_fake_bql.Service(universe_size=universe_size, nan_ratio=nan_ratio)
+    factors = build_factors(connection)
+    backtest = Backtest(factors, connection, 'SXXP Index', ['2020-01-31', '2020-02-28', '2020-03-31'], weights={'Value': 70, 'Other': 30},
+                        rank_num=rank_num)
+    backtest.run()
+    differences = []
+    if backtest.weights.to_dict() != {'Value': 70., 'Quality': 0.}:
+        differences.append('weights: {} instead of Value 70 and Quality 0'.format(backtest.weights.to_dict()))
+    returns = backtest.portfolio_returns
+    for date, data in backtest.results.items():
+        forward_return = data['Forward Return']
+        for rank_method in ['Top', 'Bottom']:
+            expected = screen_total_score(data[factors.total_score_factors], backtest.weights, rank_method, rank_num).index
+            if set(backtest.portfolio(date, rank_method)) != set(expected):
+                differences.append('{} {}: the portfolio differs from screen_total_score'.format(date, rank_method))
+            if date in returns.index and not np.isclose(returns.loc[date, rank_method], forward_return[expected].mean(), equal_nan=True):
+                differences.append('{} {}: the portfolio return differs'.format(date, rank_method))
+        if date in returns.index and not np.isclose(returns.loc[date, 'Universe'], forward_return.mean()):
+            differences.append('{}: the universe return differs'.format(date))
+    if len(returns) != len(backtest.dates) - 1:
+        differences.append('{} dates with returns instead of {}'.format(len(returns), len(backtest.dates) - 1))
+    return differences
+
+
+def grouped_reference(values, labels, transform):
+    ''' Applies transform to each column of values within the groups of labels with pandas (rows without a group get NaN).'''
+    data = pd.DataFrame(values)
+    return data.groupby(pd.Series(labels)).transform(transform).reindex(data.index).values
+
+
+def winsorize_reference(values, labels, lower, upper):
+    clipped = grouped_reference(values, labels, lambda s: s.clip(s.quantile(lower), s.quantile(upper)))
+    return np.where(pd.isnull(labels)[:, None], values, clipped)
+
+
+def check_grouped(size=1000, seed=0):
+    ''' The grouped functions of utils_scoring against pandas groupby, with ties, NaNs and names without a group.'''
+    random = np.random.RandomState(seed)
+    values = np.round(random.normal(size=(size, 3)), 1)
+    values[random.uniform(size=values.shape) < 0.1] = np.nan
+    labels = random.choice(['A', 'B', 'C', 'D', 'E'], size=size).astype(object)
+    labels[random.uniform(size=size) < 0.05] = None
+    labels[0] = 'Single'
+    codes, group_count = group_codes(labels)
+    signs, relative_weights, fillna_value, winsorize = [1., -1., 1.], [1., 2., 0.5], 0., (0.05, 0.8)
+
+    def zscore(s):
+        return (s - s.mean()) / s.std(ddof=1)
+
+    def rank(s):
+        return s.rank(method='max', ascending=False)
+
+    winsorized = winsorize_reference(values, labels, *winsorize)
+    scores = grouped_reference(winsorized * signs, labels, zscore)
+    scores[np.isnan(scores)] = fillna_value
+    weights = np.asarray(relative_weights)
+    references = OrderedDict([
+        ('group_zscore', (group_zscore(values, codes, group_count), grouped_reference(values, labels, zscore))),
+        ('group_rank_max', (group_rank_max(values, codes, group_count), grouped_reference(values, labels, rank))),
+        ('group_winsorize', (group_winsorize(values, codes, group_count, *winsorize), winsorized)),
+        ('neutral_zscore', (
+            neutral_zscore(values, labels, signs, relative_weights, fillna_value, winsorize),
+            scores.dot(weights) / (weights ** 2).sum() ** 0.5,
+        )),
+        ('neutral_rank', (
+            neutral_rank(values, labels, signs, relative_weights, winsorize),
+            grouped_reference(winsorized * signs, labels, rank).dot(weights) / weights.sum(),
+        )),
+    ])
+    differences = []
+    for name, (actual, expected) in references.items():
+        same = np.isclose(actual, expected, rtol=1e-9, atol=1e-9, equal_nan=True)
+        if not same.all():
+            differences.append('{}: {} of {} values differ'.format(name, int((~same).sum()), same.size))
+    return differences
+
+
+def check_non_finite():
+    ''' Infinite values and divisions by zero are missing values, which do not change the scores of the other names.'''
+    differences = []
+    values = np.array([1., 2., 3., np.inf, 5., -np.inf])
+    expected = weighted_zscore(np.where(np.isfinite(values), values, np.nan), [1.], [1.], -3.)
+    if not np.allclose(weighted_zscore(values, [1.], [1.], -3.), expected, equal_nan=True):
+        differences.append('weighted_zscore: infinite values change the scores of the other names')
+    raw_data = pd.DataFrame({'a': [1., 2., 0., np.nan], 'b': [2., 0., 0., 1.]})
+    actual = LocalExpression('div', ['a', 'b']).evaluate(raw_data)
+    if not np.allclose(actual, [0.5, np.nan, np.nan, np.nan], equal_nan=True):
+        differences.append('LocalExpression: {} instead of [0.5, nan, nan, nan] for a division by zero'.format(actual.tolist()))
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks the local scoring against the bql server path and against pandas.')
+    parser.add_argument('--universe-size', type=int, default=500, help='Number of members of the synthetic index.')
+    parser.add_argument('--nan-ratio', type=float, default=0.2, help='Share of missing values of the synthetic fields.')
+    args = parser.parse_args(argv)
+
+    checks = OrderedDict([
+        ('local scoring vs server', lambda: check_engine(args.universe_size, args.nan_ratio)),
+        ('grouped functions vs pandas', check_grouped),
+        ('backtest portfolios', lambda: check_backtest(args.universe_size, args.nan_ratio)),
+        ('infinite values', check_non_finite),
+    ])
+    failed = False
+    for name, check in checks.items():
+        differences = check()
+        print('{}: {}'.format(name, 'ok' if len(differences) == 0 else 'FAILED'))
+        for difference in differences:
+            print('    ' + difference)
+        failed = failed or len(differences) > 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
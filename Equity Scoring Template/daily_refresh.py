@@ -0,0 +1,155 @@
+import os
+import re
+from collections import OrderedDict
+
+import pandas as pd
+
+from utils_factors import expression_key
+from utils_general import get_raw_data, UniverseSnapshot
+
+
+# Incremental refresh of a screen that is run every day on the same universe (e.g. the morning production run).
+# The raw inputs of the previous run are kept on disk; each run fetches in full the fields that move with
+# the price, and the other fields (fundamentals, sectors, etc.) only for the names that joined the universe
+# or published a new filing since the previous run. The scores are then recomputed locally from all inputs.
+
+PRICE_MARKERS = [
+    'px_', 'market_cap', 'mkt_cap', 'pe_ratio', 'ev_to', 'enterprise_value', 'yield', 'pct_chg', 'volatility', 'beta', 'total_return',
+]
+
+SNAPSHOT_PRICE_FIELDS = ['MARKET_CAP']
+SNAPSHOT_FIELDS = ['GICS_SECTOR_NAME', 'COUNTRY_FULL_NAME']
+FILING_FIELD = 'FILING_DATE'
+
+
+def is_price_driven(column, bql_function):
+    ''' True if the BQL text of the input uses a price (px_last, market cap, ratios to the price, returns, etc.).'''
+    text = repr(bql_function).lower()
+    return any(marker in text for marker in PRICE_MARKERS)
+
+
+def changed_filings(old, new):
+    ''' True for the names whose filing date differs from the previous run (missing values compare equal).'''
+    old = old.reindex(new.index)
+    return ~((old == new) | (old.isnull() & new.isnull()))
+
+
+class DailyRefresh(object):
+
+    def __init__(self, engine, path, price_driven=None, filing_field=None):
+        '''
+        Summary:
+            Scores the screens of a ScoringEngine from the raw inputs of the previous run of the same universe
+            and currency. Each run sends two requests: one for the members with their market cap, their filing
+            date and the price-driven inputs, and one for the other inputs of the new members and of the names
+            whose filing date changed. Nothing is kept if the inputs of the factors changed since the previous run.
+        Args:
+            engine (ScoringEngine): the engine whose factors, connection, currency parameters and selection are used.
+            path (str): the folder where the raw inputs of the last run of each universe and currency are kept.
+            price_driven (function): called with the column name and the bql function of each input, returns True
+                for the inputs refetched in full every day. Defaults to is_price_driven.
+            filing_field (bql item): the field whose change signals a new filing. Defaults to the latest announcement date.
+        '''
+        self.engine = engine
+        self.path = path
+        self.price_driven = price_driven if price_driven is not None else is_price_driven
+        connection = engine.connection
+        self.filing_field = filing_field if filing_field is not None else connection.data.latest_announcement_dt()
+        self.stats = OrderedDict()
+        os.makedirs(path, exist_ok=True)
+
+    def state_path(self, params):
+        name = '{}_{}'.format(params.universe_ticker, params.currency)
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9_.-]+', '_', name) + '.pkl')
+
+    def signature(self):
+        ''' Identifies the inputs of the factors: the previous inputs are only reused if it did not change.'''
+        inputs, derived, columns = self.engine.factors.input_plan
+        return [(column, str(expression_key(bql_function)), factor.use_in_total_score) for column, (factor, bql_function) in inputs.items()]
+
+    def load_state(self, params):
+        path = self.state_path(params)
+        if not os.path.exists(path):
+            return None
+        state = pd.read_pickle(path)
+        if state['signature'] != self.signature():
+            return None
+        return state
+
+    def save_state(self, params, data):
+        state = OrderedDict([('ref_date', str(params.ref_date)), ('signature', self.signature()), ('data', data)])
+        pd.to_pickle(state, self.state_path(params))
+
+    def split_fields(self, params):
+        ''' The raw fields of the factors (see AllFactors.raw_fields), split into price-driven fields and the others.'''
+        inputs, derived, columns = self.engine.factors.input_plan
+        price_fields, other_fields = OrderedDict(), OrderedDict()
+        for column, bql_function in self.engine.raw_fields(params).items():
+            fields = price_fields if self.price_driven(column, inputs[column][1]) else other_fields
+            fields[column] = bql_function
+        return price_fields, other_fields
+
+    def fetch_prices(self, params, price_fields):
+        ''' The members at the ref_date with their market cap, filing date and price-driven inputs.'''
+        connection = self.engine.connection
+        fields = OrderedDict([
+            ('MARKET_CAP', connection.data.MARKET_CAP()/1000000),
+            (FILING_FIELD, self.filing_field),
+        ])
+        fields.update(price_fields)
+        universe = connection.univ.members([params.universe_ticker], dates=params.ref_date)
+        return get_raw_data(connection, universe, fields, with_params=self.engine.with_params(params), store=self.engine.snapshot(params))
+
+    def fetch_others(self, params, ids, other_fields):
+        ''' The sector, the country and the other inputs of the given IDs.'''
+        connection = self.engine.connection
+        fields = OrderedDict([
+            ('GICS_SECTOR_NAME', connection.data.GICS_SECTOR_NAME()),
+            ('COUNTRY_FULL_NAME', connection.data.COUNTRY_FULL_NAME().toupper()),
+        ])
+        fields.update(other_fields)
+        return get_raw_data(connection, connection.univ.list(ids), fields, with_params=self.engine.with_params(params), store=self.engine.snapshot(params))
+
+    def run(self, params):
+        '''
+        Summary:
+            Returns the scored DataFrame of the parameters, like ScoringEngine.score, and keeps the raw inputs for the next run.
+            The details of the run (members, names refetched, etc.) are in stats.
+        Args:
+            params (ScoringParameters): the parameters of the screen.
+        '''
+        engine = self.engine
+        with engine.lock:
+            engine.tracer.start_run()
+            price_fields, other_fields = self.split_fields(params)
+            state = self.load_state(params)
+            with engine.stage('prices'):
+                prices = self.fetch_prices(params, price_fields)
+            members = prices.index
+            if state is None:
+                previous = pd.DataFrame(columns=SNAPSHOT_FIELDS + list(other_fields.keys()) + [FILING_FIELD])
+            else:
+                previous = state['data']
+            changed = ~members.isin(previous.index) | changed_filings(previous[FILING_FIELD], prices[FILING_FIELD]).values
+            ids = members[changed].tolist()
+            others = previous.reindex(members).drop(columns=[FILING_FIELD])
+            if len(ids) > 0:
+                with engine.stage('fundamentals'):
+                    fetched = self.fetch_others(params, ids, other_fields)
+                others = others.astype(object)
+                others.loc[ids] = fetched.reindex(index=ids, columns=others.columns).values
+                others = others.infer_objects()
+            self.save_state(params, others.join(prices[[FILING_FIELD]]))
+            self.stats = OrderedDict([
+                ('ref_date', str(params.ref_date)), ('previous_date', None if state is None else state['ref_date']),
+                ('members', len(members)), ('refetched', len(ids)), ('joined', int((~members.isin(previous.index)).sum())),
+                ('price_fields', list(price_fields.keys())), ('other_fields', list(other_fields.keys())),
+            ])
+
+            data = prices.join(others)
+            snapshot = UniverseSnapshot(data[SNAPSHOT_PRICE_FIELDS + SNAPSHOT_FIELDS])
+            raw_data = data[list(engine.raw_fields(params).keys())]
+            raw_data = raw_data.reindex(snapshot.filter(params.min_mktcap, params.max_mktcap, params.sector, params.countries))
+            with engine.stage('local scoring'):
+                engine.set_universe_data(engine.factors.compute_local(raw_data), params)
+            return engine.select(params)
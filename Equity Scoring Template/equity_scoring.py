@@ -1,26 +1,51 @@
+import traceback
+
 import pandas as pd
 from ipywidgets import HBox, VBox
 
-from utils_general import format_floats, get_score_data, get_single_field_request
-from utils_gui import ApplicationLogger, AppTitle, ComputeButton, DEFAULT_INITIALISATION_MSG, DEFAULT_WAITING_MSG, ParameterSelection, ScreeningDataGrid, WeightsBox, TotalScoreFilter
+from scoring_engine import ScoringEngine, ScoringParameters
+from utils_frames import memory_summary
+from utils_gui import ApplicationLogger, AppTitle, ComputeButton, DEFAULT_INITIALISATION_MSG, ParameterSelection, ProgressMessage, ScreeningDataGrid, WeightsBox, TotalScoreFilter
+from utils_tasks import BackgroundRunner, CancelledError, Debouncer
 
 
 
 class EquityScoring(VBox):
     
-    def __init__(self, factors, col_defs, connection, logger=None):
+    def __init__(self, factors, col_defs, connection, logger=None, engine=None, background=True, auto_update=False, debounce_delay=0.5,
+                 **engine_options):
         self.factors = factors
         self.connection = connection
+        # the scoring logic lives in the engine; this class only reads the widgets and displays the results
+        if engine is None:
+            engine = ScoringEngine(factors=factors, connection=connection, **engine_options)
+        elif len(engine_options) > 0:
+            raise ValueError('The options {} are those of the engine: pass them to the ScoringEngine'.format(', '.join(sorted(engine_options))))
+        self.engine = engine
         if logger is None:
             logger = list()
         self.logger = logger
+        self.error = None
         self.parameter_selection = ParameterSelection()
         self.weights_box = WeightsBox(fields=factors.total_score_factors)
         self.top_bottom_filter = TotalScoreFilter()
         self.ctrl_button = ComputeButton(description='Update', on_click= lambda x: self.compute(), button_style='success', width=120)
+        self.cancel_button = ComputeButton(description='Cancel', on_click= lambda x: self.cancel(), button_style='warning', width=120)
+        self.progress_msg = ProgressMessage()
+        self.waiting_display = HBox([self.progress_msg, self.cancel_button])
         self.datagrid = ScreeningDataGrid(data = pd.DataFrame(), col_defs=col_defs)
-        self.init_display = [self.parameter_selection, self.weights_box, self.top_bottom_filter, self.ctrl_button, DEFAULT_INITIALISATION_MSG, self.datagrid]
+        self.init_display = self.display_with(DEFAULT_INITIALISATION_MSG)
         super().__init__(children=self.init_display)
+        # with background, the computations run in a thread: a new Update cancels the one in flight
+        self.runner = BackgroundRunner() if background else None
+        # weights and Top/Bottom changes are applied at once (they take milliseconds); only the recomputations are debounced
+        self.selection_pending = False
+        if self.engine.incremental:
+            self.weights_box.on_change(lambda change: self.update_selection())
+            self.top_bottom_filter.on_change(lambda change: self.update_selection())
+        if auto_update:
+            compute = Debouncer(self.compute, debounce_delay)
+            self.parameter_selection.on_change(lambda change: compute())
     
     @property
     def countries(self):
@@ -32,10 +57,7 @@ class EquityScoring(VBox):
     
     @property
     def fields(self):
-        fields = [f for factor in self.factors.factors for f in factor.fields.keys()]
-        if len(self.factors.total_score_factors)>0:
-            fields.insert(self.factors.total_score_position, 'Total Score')
-        return fields
+        return self.engine.fields
     
     @property
     def max_mktcap(self):
@@ -69,98 +91,114 @@ class EquityScoring(VBox):
     def rank_num(self):
         return self.top_bottom_filter.num_stocks.value
     
-    def compute(self):
-        self.children = [self.parameter_selection, self.weights_box, self.top_bottom_filter, self.ctrl_button, DEFAULT_WAITING_MSG]
-        self.update_data()
-        self.datagrid.data = self.data.reset_index().rename(columns={'ID': 'Ticker'}).dropna()
-        self.children = self.init_display
+    @property
+    def parameters(self):
+        return ScoringParameters(
+            universe_ticker=self.universe_ticker, ref_date=self.ref_date, currency=self.currency, region=self.parameter_selection.region.value,
+            sector=self.sector, min_mktcap=self.min_mktcap, max_mktcap=self.max_mktcap, weights=self.weights,
+            rank_method=self.rank_method, rank_num=self.rank_num, countries=self.countries,
+        )
     
-    def apply_as_of_date(self, fields, ref_date, apply_ref_date=False):
-        if apply_ref_date:
-            fld_keys = fields.keys()
-            for fld in fld_keys:
-                fields[fld] = fields[fld].as_of(ref_date)
-        return fields
-    
-    def apply_match_screen_results(self, fields, screen_results):
-        fld_keys = fields.keys()
-        for fld in fld_keys:
-            fields[fld] = self.connection.func.matches(fields[fld], self.connection.data.id().in_(screen_results))
-        return fields
-    
-    def create_total_score_field(self):
-        factor_in_use = [f for f in self.factors.factors if f.use_in_total_score]
-        factor_in_use_field = []
-
-        for f in factor_in_use:
-            fields = self.apply_as_of_date(f.fields, self.ref_date, f.use_in_total_score)
-
-            for k in fields:
-                factor_in_use_field.append(fields[k])
-
-        w = self.weights.divide(100).tolist()
-
-        total_score_field = factor_in_use_field[0] * w[0]
-
-        for i in range(1, len(w)):
-            total_score_field = total_score_field + factor_in_use_field[i] * w[i]
-        
-        return total_score_field
+    def display_with(self, message):
+        return [self.parameter_selection, self.weights_box, self.top_bottom_filter, self.ctrl_button, message, self.datagrid, self.datagrid.pager]
     
-    def create_total_score_screen(self, universe):
-        total_score_field = self.create_total_score_field()
-        
-        if self.rank_method == 'Bottom':
-            total_score_field = -1 * total_score_field
-            
-        return self.connection.univ.filter(universe, self.connection.func.grouprank(total_score_field) <= self.rank_num)
+    def compute(self):
+        ''' Scores the selected parameters, in the background if the app was created with background=True
+        (in that case the Future of the run is returned).'''
+        params = self.parameters
+        if self.runner is None:
+            return self.run_compute(params)
+        return self.runner.submit(self.run_compute, params)
+    
+    def is_latest(self, token):
+        return token is None or self.runner.is_latest(token)
+    
+    def run_compute(self, params, token=None):
+        # the previous table stays visible until the new one is ready
+        self.progress_msg.update('Computing...')
+        self.children = self.display_with(self.waiting_display)
+        # in the background nobody reads the Future of the run: the errors of the display are logged like those of the computations
+        try:
+            if self.update_data(params, token):
+                with self.engine.tracer.stage('render'):
+                    self.show_data()
+                self.logger.append(self.engine.tracer.summary)
+        except Exception as error:
+            self.log_error(error, 'display')
+        finally:
+            if self.is_latest(token):
+                self.children = self.init_display
+            if self.selection_pending:
+                try:
+                    self.update_selection()
+                except Exception as error:
+                    self.log_error(error, 'selection')
+    
+    def log_error(self, error, stage='computations'):
+        ''' Keeps the traceback of the error in self.error and logs the error in red.'''
+        self.error = traceback.format_exc()
+        message = 'There was an ERROR during the {}: {}: {}'.format(stage, type(error).__name__, error)
+        if isinstance(self.logger, ApplicationLogger):
+            self.logger.append(message, color='red')
+        else:
+            self.logger.append(message)
+    
+    def cancel(self):
+        if self.runner is not None:
+            self.runner.cancel()
+        self.children = self.init_display
     
+    def show_data(self):
+        self.datagrid.set_data(self.data.reset_index().rename(columns={'ID': 'Ticker'}).dropna())
     
-    def update_data(self):
+    def update_selection(self):
+        # only Total Score and Top/Bottom selection are recomputed, from the scores in memory.
+        # While a run holds the engine, the selection is left to the run, which applies it once done (see run_compute)
+        self.selection_pending = True
+        if not self.engine.lock.acquire(blocking=False):
+            return
+        try:
+            self.selection_pending = False
+            if self.engine.universe_data is None:
+                return
+            self.data = self.engine.select(self.parameters)
+        finally:
+            self.engine.lock.release()
+        self.show_data()
+    
+    def update_data(self, params=None, token=None):
+        '''
+        Summary:
+            Scores the parameters (defaults to the selected ones) and keeps the result in self.data.
+            Returns False if the computations failed (the error is kept in self.error) or were cancelled,
+            or if a newer run was started in the meantime (its result is the one to be displayed).
+        '''
+        if params is None:
+            params = self.parameters
         self.logger.append("Computing data with selected parameters")
         try:
-            universe = self.connection.univ.members([self.universe_ticker], dates=self.ref_date)
-            filter_mktcap = self.connection.func.between(
-                self.connection.data.MARKET_CAP()/1000000, int(self.min_mktcap), int(self.max_mktcap))
-            universe = self.connection.univ.filter(universe, filter_mktcap)
-            
-            if self.sector != 'All':
-                filter_sector = self.connection.func.in_(self.connection.data.GICS_SECTOR_NAME(), [self.sector])
-                universe = self.connection.univ.filter(universe, filter_sector)
-            if self.countries is not None:
-                filter_countries = self.connection.func.in_(self.connection.data.COUNTRY_FULL_NAME().toupper(), self.countries)
-                universe = self.connection.univ.filter(universe, filter_countries)
-            
-            # screen with the total score
-            screen = self.create_total_score_screen(universe)
-            screen_results = get_single_field_request(
-                connection=self.connection, universe=screen, field=self.connection.data.id(), field_name='ID', with_params={'currency': self.currency, 'fill': 'prev', 'mode': 'cached'}
-            ).ID.tolist()
-            
-            data = pd.concat(
-                [get_score_data(
-                        connection=self.connection,
-                        universe=universe,
-                        fields=self.apply_match_screen_results(self.apply_as_of_date(factor.fields, self.ref_date, factor.use_in_total_score), screen_results),
-                        with_params={'currency': self.currency, 'fill': 'prev', 'mode': 'cached'},
-                        preferences={'SkipNa': factor.skipna_preference},
-                    ).T
-                for factor in self.factors.factors]
-            ).T
-            # Compute Total Score
-            total_score_factors = self.factors.total_score_factors
-            if len(total_score_factors) > 0:
-                total_score = data[total_score_factors].multiply(self.weights.divide(100)).sum(axis=1).apply(format_floats).to_frame('Total Score')
-                data = data.join(total_score).sort_values(by='Total Score', ascending=False)
-            self.data = data
-            self.logger.append('Finished Computing')
-        except:
-            self.logger.append('There was an ERROR during in the computations')
+            data = self.engine.score(params, token=token, progress=self.progress_msg.update)
+        except CancelledError:
+            self.logger.append('Computation cancelled')
+            return False
+        except Exception as error:
+            self.log_error(error)
+            return False
+        if not self.is_latest(token):
+            return False
+        self.data = data
+        self.error = None
+        self.logger.append('Finished Computing')
+        self.logger.append(memory_summary(data))
+        if self.engine.summary is not None:
+            self.logger.append(self.engine.summary)
+        return True
 
 
 class EquityScoringApp(VBox):
     
-    def __init__(self, factors, col_defs, connection, title, description=None):
+    def __init__(self, factors, col_defs, connection, title, description=None, engine=None, background=True, auto_update=False,
+                 debounce_delay=0.5, **engine_options):
         """
         Summary:
             A Container for the Asset Allocation App. The logger and the app are initialised here.
@@ -170,10 +208,20 @@ class EquityScoringApp(VBox):
             connection (bq connection): a connection to the bql server initialised with bql.Service().
             title (str): the title of the app to be displayed on top in big characters.
             description (str): the description of the app to be displayed below the title in smaller characters.
+            engine (ScoringEngine): the engine scoring the screens, e.g. ScoringEngine(factors, connection, local_scoring=True,
+                incremental=True). Defaults to a ScoringEngine of the factors and the connection with engine_options.
+            background (bool): if True, Update runs the computations in a background thread, so that the widgets stay responsive;
+                clicking Update again (or Cancel) stops the run in flight, and only the result of the latest run is displayed.
+            auto_update (bool): if True, the screen is recomputed after each change of the parameters.
+            debounce_delay (float): with auto_update, the number of seconds without changes to wait for before recomputing,
+                so that quick edits only trigger one update (weights and Top/Bottom changes are applied at once).
+            engine_options: without engine, the options of the ScoringEngine (local_scoring, max_workers, incremental, etc.,
+                see ScoringEngine). With incremental, weights and Top/Bottom changes are applied without fetching data.
         """
         self.title = title
         self.description = description
         self.logger = ApplicationLogger()
-        self.app = EquityScoring(factors=factors, col_defs=col_defs, connection=connection)
-        super().__init__(children=[AppTitle(title=self.title, description=description), self.app])
+        self.app = EquityScoring(factors=factors, col_defs=col_defs, connection=connection, logger=self.logger, engine=engine,
+                                 background=background, auto_update=auto_update, debounce_delay=debounce_delay, **engine_options)
+        super().__init__(children=[AppTitle(title=self.title, description=description), self.logger, self.app])
     
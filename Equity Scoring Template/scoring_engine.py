@@ -0,0 +1,624 @@
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+import pandas as pd
+
+from utils_cache import CachedConnection, ResponseCache
+from utils_general import create_universe, get_batched_score_data, get_chunked_raw_data, get_raw_data, get_single_field_request, load_regions, run_in_parallel, UniverseSnapshot
+from utils_scoring import ScoreIndex, screen_total_score, sweep_total_scores, total_score
+from utils_frames import compact_frame, TickerPool
+from utils_trace import Tracer, TracedConnection
+
+
+class ScoringParameters(object):
+
+    def __init__(self, universe_ticker='SX5E Index', ref_date=None, currency='EUR', region='All', sector='All', min_mktcap=0,
+                 max_mktcap=10000000, weights=None, rank_method='Top', rank_num=50, countries=None, name=None):
+        '''
+        Summary:
+            The parameters of a screen, as selected in the widgets of the app. Defaults to the app's initial values.
+        Args:
+            universe_ticker (str): the ticker of the index, e.g. 'SX5E Index'.
+            ref_date (str): the reference date. Defaults to today.
+            currency (str): the currency of the data.
+            region (str): a region of regions_mapping.csv, or 'All'.
+            sector (str): a GICS sector name, or 'All'.
+            min_mktcap (int): the minimum market cap in millions.
+            max_mktcap (int): the maximum market cap in millions.
+            weights (dict): the Total Score weights in percent, mapped by factor name. Defaults to equal weights.
+            rank_method (str): 'Top' or 'Bottom'.
+            rank_num (int): the number of stocks to keep.
+            countries (list): the upper case country names to be kept; overrides the region.
+            name (str): the name of the screen, e.g. for the output file of the command line.
+        '''
+        self.universe_ticker = universe_ticker
+        if ref_date is None:
+            ref_date = str(datetime.date.today())
+        self.ref_date = ref_date
+        self.currency = currency
+        self.region = region
+        self.sector = sector
+        self.min_mktcap = min_mktcap
+        self.max_mktcap = max_mktcap
+        self.weights = weights
+        self.rank_method = rank_method
+        self.rank_num = rank_num
+        if countries is None and region != 'All':
+            countries = load_regions()[region]
+        self.countries = countries
+        self.name = name
+
+    @property
+    def key(self):
+        ''' The name of the screen, or a description of its universe.'''
+        if self.name is not None:
+            return self.name
+        return ' | '.join([self.universe_ticker, self.region, self.sector])
+
+    @property
+    def universe_key(self):
+        ''' The parameters defining the filtered universe (all but the weights and the Top/Bottom selection).'''
+        countries = None if self.countries is None else tuple(self.countries)
+        return (self.universe_ticker, str(self.ref_date), self.currency, self.sector, self.min_mktcap, self.max_mktcap, countries)
+
+    def copy(self, **changes):
+        ''' Returns a copy of the parameters, with the given changes (e.g. universe_ticker='SPX Index').'''
+        values = dict(self.__dict__)
+        if 'region' in changes and 'countries' not in changes:
+            values['countries'] = None
+        values.update(changes)
+        return ScoringParameters(**values)
+
+    @classmethod
+    def from_dict(cls, values):
+        ''' Builds the parameters from a dict, e.g. an element of the JSON parameter file of the command line.'''
+        values = dict(values)
+        if 'universe' in values:
+            values['universe_ticker'] = values.pop('universe')
+        return cls(**values)
+
+
+class ScoringEngine(object):
+
+    def __init__(self, factors, connection, local_scoring=False, max_workers=None, request_timeout=None, batch_requests=False, store=None,
+                 incremental=False, local_filters=False, chunk_size=None, max_memory=None, tracer=None, lazy_details=False, compact=False,
+                 float32=False):
+        '''
+        Summary:
+            The scoring logic of the app, without any widget: it takes ScoringParameters and returns the scored DataFrame.
+        Args:
+            factors (AllFactors): the factors of the model.
+            connection (bq connection): a connection to the bql server initialised with bql.Service().
+            local_scoring (bool): if True, the scores are computed locally from the raw values (see utils_scoring).
+            max_workers (int): if given, the requests are sent concurrently with at most max_workers threads.
+            request_timeout (float): the maximum number of seconds to wait for each group of concurrent requests (e.g. all the factors).
+            batch_requests (bool): if True, factors with the same preferences share a single request.
+            store (SnapshotStore): if given, the responses of past dates are kept on disk and reused in later sessions.
+            incremental (bool): if True, the scores of the whole filtered universe are kept in memory (universe_data),
+                so that new weights or Top/Bottom selections can be applied with select() without fetching any data.
+            local_filters (bool): if True, the members of the universe are fetched once per universe, date and currency
+                with their market cap, sector and country (see UniverseSnapshot), and the filters are applied locally.
+                With local_scoring, the raw values of all members are kept too, so that changing the filters
+                costs no request.
+            chunk_size (int): with local_scoring, the raw values are requested for chunk_size IDs at a time
+                (see get_chunked_raw_data), for very large universes. The scores are computed once all chunks are back.
+            max_memory (int): with local_scoring and no chunk_size, the chunks are sized so that the responses of one
+                chunk take at most max_memory bytes.
+            tracer (Tracer): records the duration of each stage and request (see utils_trace). Defaults to a new Tracer.
+            lazy_details (bool): with incremental (and without local_scoring), only the factors used in the Total Score are
+                fetched for the whole universe; the other factors (e.g. names, sectors) are fetched for the selected names
+                only, and kept for the names already loaded.
+            compact (bool): if True, the scored DataFrames are stored compactly (see compact_frame): text columns as
+                categoricals and tickers interned, so that the frames of many screens or dates share their strings.
+            float32 (bool): with compact, the scores are stored as float32 (half the memory of float64).
+        '''
+        if not local_scoring and any(factor.local_only for factor in factors.factors):
+            raise ValueError('The neutral factors are computed from the raw values: use local_scoring=True')
+        # options that would be ignored
+        if not local_scoring and (chunk_size is not None or max_memory is not None):
+            raise ValueError('chunk_size and max_memory split the requests of the raw values: use local_scoring=True')
+        if chunk_size is not None and max_memory is not None:
+            raise ValueError('max_memory only sizes the chunks when no chunk_size is given')
+        if lazy_details and (not incremental or local_scoring):
+            raise ValueError('lazy_details only applies with incremental=True and without local_scoring')
+        if float32 and not compact:
+            raise ValueError('float32 only applies with compact=True')
+        self.factors = factors
+        if tracer is None:
+            tracer = Tracer()
+        self.tracer = tracer
+        self.connection = TracedConnection(connection, tracer, label=self.request_label, before=self.checkpoint, after=self.request_done)
+        self.token = None
+        self.progress = None
+        self.local_scoring = local_scoring
+        self.max_workers = max_workers
+        self.request_timeout = request_timeout
+        self.batch_requests = batch_requests
+        self.store = store
+        self.incremental = incremental
+        self.local_filters = local_filters
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self.lazy_details = lazy_details
+        self.compact = compact
+        self.float32 = float32
+        self.tickers = TickerPool()
+        self.universe_data = None
+        self.universe_key = None
+        self.ranking = None
+        self.details = None
+        self.snapshots = ResponseCache(max_size=8)
+        # score, select and sweep share the state above: one at a time (e.g. a selection while a run is in the background)
+        self.lock = threading.RLock()
+
+    @property
+    def fields(self):
+        fields = [f for factor in self.factors.factors for f in factor.fields.keys()]
+        if len(self.factors.total_score_factors)>0:
+            fields.insert(self.factors.total_score_position, 'Total Score')
+        return fields
+
+    def request_label(self, names):
+        ''' The name of a request in the traces: the factors of its fields (or the field names).'''
+        factor_names = OrderedDict()
+        for factor in self.factors.factors:
+            factor_names.update((name, factor.name) for name in factor.fields.keys())
+        factor_names.update((column, factor.name) for column, (factor, bql_function) in self.factors.input_plan[0].items())
+        labels = list(OrderedDict.fromkeys(factor_names.get(name, name) for name in names))
+        if len(labels) > 3:
+            labels = labels[:3] + ['+{}'.format(len(labels) - 3)]
+        return ', '.join(labels)
+
+    def checkpoint(self, message=None):
+        ''' Stops the current run if its token was cancelled (see utils_tasks), and reports the progress.'''
+        if self.token is not None:
+            self.token.check()
+        if message is not None and self.progress is not None:
+            self.progress(message)
+
+    @contextmanager
+    def stage(self, name):
+        self.checkpoint(name + '...')
+        with self.tracer.stage(name):
+            yield
+
+    def request_done(self, label, duration, details):
+        if self.progress is not None:
+            self.progress('{}: {:,} rows in {:.2f}s'.format(label, details['rows'], duration))
+
+    def raw_fields(self, params):
+        return self.factors.raw_fields(params.ref_date)
+
+    def weights(self, params):
+        total_score_factors = self.factors.total_score_factors
+        if params.weights is None:
+            return pd.Series(100. / max(len(total_score_factors), 1), index=total_score_factors)
+        return pd.Series(params.weights).reindex(total_score_factors).fillna(0.)
+
+    def with_params(self, params):
+        return {'currency': params.currency, 'fill': 'prev', 'mode': 'cached'}
+
+    def snapshot(self, params):
+        if self.store is None:
+            return None
+        return self.store.partition(params.ref_date, params.universe_ticker, params.currency)
+
+    def apply_as_of_date(self, fields, ref_date, apply_ref_date=False):
+        # returns new fields: the compiled fields of the factors are never modified
+        if apply_ref_date:
+            return OrderedDict([(fld, field.as_of(ref_date)) for fld, field in fields.items()])
+        return OrderedDict(fields)
+
+    def apply_match_screen_results(self, fields, screen_results):
+        screen_match = self.connection.data.id().in_(screen_results)
+        return OrderedDict([(fld, self.connection.func.matches(field, screen_match)) for fld, field in fields.items()])
+
+    def create_total_score_field(self, params):
+        factor_in_use = [f for f in self.factors.factors if f.use_in_total_score]
+        factor_in_use_field = []
+
+        for f in factor_in_use:
+            fields = self.apply_as_of_date(f.fields, params.ref_date, f.use_in_total_score)
+
+            for k in fields:
+                factor_in_use_field.append(fields[k])
+
+        w = self.weights(params).divide(100).tolist()
+
+        total_score_field = factor_in_use_field[0] * w[0]
+
+        for i in range(1, len(w)):
+            total_score_field = total_score_field + factor_in_use_field[i] * w[i]
+
+        return total_score_field
+
+    def create_total_score_screen(self, universe, params):
+        total_score_field = self.create_total_score_field(params)
+
+        if params.rank_method == 'Bottom':
+            total_score_field = -1 * total_score_field
+
+        return self.connection.univ.filter(universe, self.connection.func.grouprank(total_score_field) <= params.rank_num)
+
+    def snapshot_key(self, params):
+        return (params.universe_ticker, str(params.ref_date), params.currency)
+
+    def universe_snapshot(self, params):
+        ''' The UniverseSnapshot of the parameters, fetched on first use.'''
+        key = self.snapshot_key(params) + ('members',)
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            with self.stage('members'):
+                snapshot = UniverseSnapshot.fetch(
+                    self.connection, params.universe_ticker, params.ref_date, with_params=self.with_params(params), store=self.snapshot(params))
+            self.snapshots.set(key, snapshot)
+        return snapshot
+
+    def filtered_members(self, params):
+        return self.universe_snapshot(params).filter(params.min_mktcap, params.max_mktcap, params.sector, params.countries)
+
+    def base_raw_data(self, params):
+        ''' The raw values of all members of the UniverseSnapshot, fetched on first use.'''
+        key = self.snapshot_key(params) + ('raw',)
+        raw_data = self.snapshots.get(key)
+        if raw_data is None:
+            with self.stage('raw data'):
+                raw_data = self.fetch_raw_data(params, ids=self.universe_snapshot(params).ids.tolist())
+            self.snapshots.set(key, raw_data)
+        return raw_data
+
+    @property
+    def chunked(self):
+        return self.chunk_size is not None or self.max_memory is not None
+
+    def fetch_raw_data(self, params, universe=None, ids=None, store=None):
+        ''' The raw values of the universe (or of the given IDs), in chunks if chunk_size or max_memory is set.'''
+        if store is None:
+            store = self.snapshot(params)
+        if self.chunked:
+            if ids is None:
+                ids = self.fetch_ids(universe, params)
+            return get_chunked_raw_data(
+                connection=self.connection, ids=ids, fields=self.raw_fields(params), with_params=self.with_params(params),
+                chunk_size=self.chunk_size, max_memory=self.max_memory, store=store,
+            )
+        if universe is None:
+            universe = self.connection.univ.list(ids)
+        return get_raw_data(
+            connection=self.connection, universe=universe, fields=self.raw_fields(params), with_params=self.with_params(params), store=store,
+        )
+
+    def create_universe(self, params):
+        if self.local_filters:
+            return self.connection.univ.list(self.filtered_members(params))
+        return create_universe(
+            connection=self.connection, universe_ticker=params.universe_ticker, ref_date=params.ref_date,
+            min_mktcap=params.min_mktcap, max_mktcap=params.max_mktcap, sector=params.sector, countries=params.countries,
+        )
+
+    def fetch_universe_data(self, universe, params):
+        # the factor scores of the whole filtered universe, without the Total Score screen
+        if self.local_scoring and self.local_filters:
+            raw_data = self.base_raw_data(params).reindex(self.filtered_members(params))
+        elif self.local_scoring:
+            with self.stage('raw data'):
+                raw_data = self.fetch_raw_data(params, universe=universe)
+        else:
+            factors = self.total_score_factors if self.deferred_details else None
+            factors_data = self.fetch_factors_data(universe, params, factors=factors)
+            with self.stage('join'):
+                return pd.concat(factors_data, axis=1)
+        with self.stage('local scoring'):
+            return self.factors.compute_local(raw_data)
+
+    def fetch_screen_results(self, universe, params):
+        # screen with the total score
+        screen = self.create_total_score_screen(universe, params)
+        with self.stage('screen'):
+            return get_single_field_request(
+                connection=self.connection, universe=screen, field=self.connection.data.id(), field_name='ID',
+                with_params=self.with_params(params), store=self.snapshot(params),
+            ).ID.tolist()
+
+    def factor_fields(self, factor, params, screen_results=None):
+        fields = self.apply_as_of_date(factor.fields, params.ref_date, factor.use_in_total_score)
+        if screen_results is not None:
+            fields = self.apply_match_screen_results(fields, screen_results)
+        return fields
+
+    def fetch_factors_data(self, universe, params, screen_results=None, factors=None):
+        if factors is None:
+            factors = self.factors.factors
+        with self.stage('factors'):
+            return get_batched_score_data(
+                connection=self.connection,
+                universe=universe,
+                fields_list=[self.factor_fields(factor, params, screen_results) for factor in factors],
+                with_params=self.with_params(params),
+                preferences_list=[{'SkipNa': factor.skipna_preference} for factor in factors],
+                batch=self.batch_requests,
+                max_workers=self.max_workers,
+                timeout=self.request_timeout,
+                store=self.snapshot(params),
+            )
+
+    def fetch_data(self, universe, params):
+        if self.max_workers is None:
+            screen_results = self.fetch_screen_results(universe, params)
+            factors_data = self.fetch_factors_data(universe, params, screen_results)
+        else:
+            # the screen and the factors are requested at the same time: the factors are requested
+            # for the whole universe and restricted to the screen results once they are all back
+            screen_results, factors_data = run_in_parallel(
+                [partial(self.fetch_screen_results, universe, params), partial(self.fetch_factors_data, universe, params)],
+                timeout=self.request_timeout)
+        # factors requested without SkipNa return the whole universe (NaN outside the screen): keep the screen results only
+        factors_data = [df[df.index.isin(screen_results)] for df in factors_data]
+        with self.stage('join'):
+            return pd.concat(factors_data, axis=1)
+
+    @property
+    def total_score_factors(self):
+        return [factor for factor in self.factors.factors if factor.use_in_total_score]
+
+    @property
+    def deferred_details(self):
+        # the details are only deferred if some factors are used in the Total Score and some are not
+        return self.lazy_details and not self.local_scoring and 0 < len(self.total_score_factors) < len(self.factors.factors)
+
+    def ranked_scores(self, params):
+        ''' The Total Score of universe_data and its ScoreIndex, computed once per weights.'''
+        weights = self.weights(params)
+        key = tuple(weights.items())
+        if self.ranking is None or self.ranking[0] != key:
+            data = self.universe_data.join(total_score(self.universe_data, weights))
+            complete = data[weights.index.tolist()].notnull().all(axis=1)
+            self.ranking = (key, data, ScoreIndex(data['Total Score'].where(complete)))
+        return self.ranking[1], self.ranking[2]
+
+    def with_details(self, data, params):
+        ''' Adds the factors not used in the Total Score, fetching them only for the names not loaded yet.'''
+        key = self.snapshot_key(params)
+        if self.details is None or self.details[0] != key:
+            self.details = (key, pd.DataFrame())
+        details = self.details[1]
+        missing = data.index[~data.index.isin(details.index)].tolist()
+        if len(missing) > 0:
+            factors = [factor for factor in self.factors.factors if not factor.use_in_total_score]
+            fetched = pd.concat(self.fetch_factors_data(self.connection.univ.list(missing), params, factors=factors), axis=1)
+            details = pd.concat([details, fetched.reindex(missing)])
+            self.details = (key, details)
+        data = data.join(details.reindex(data.index))
+        return data[[f for factor in self.factors.factors for f in factor.fields.keys()] + ['Total Score']]
+
+    def select(self, params, universe_data=None):
+        '''
+        Summary:
+            Total Score and Top/Bottom screen computed in memory, from universe_data (defaults to the last one fetched).
+            For the last universe_data, the names are sorted once per weights (see ScoreIndex), so that
+            changing Top/Bottom or the number of stocks only takes a slice of the sorted names.
+        '''
+        with self.lock:
+            if universe_data is not None:
+                if len(self.factors.total_score_factors) == 0:
+                    return universe_data
+                with self.stage('select'):
+                    return screen_total_score(universe_data, self.weights(params), params.rank_method, params.rank_num)
+            if len(self.factors.total_score_factors) == 0:
+                return self.universe_data
+            with self.stage('select'):
+                data, index = self.ranked_scores(params)
+                data = data.loc[index.select(params.rank_method, params.rank_num)]
+            if self.deferred_details:
+                data = self.with_details(data, params)
+            return data
+
+    def score(self, params, token=None, progress=None):
+        '''
+        Summary:
+            Returns the scored DataFrame for the given ScoringParameters.
+        Args:
+            params (ScoringParameters): the parameters of the screen.
+            token (CancelToken): if given, the run stops with a CancelledError at the next stage or request once it is cancelled.
+            progress (function): if given, called with a message at each stage and request.
+        '''
+        with self.lock:
+            self.token = token
+            self.progress = progress
+            try:
+                return self.compacted(self.run_score(params))
+            finally:
+                self.token = None
+                self.progress = None
+
+    def load_universe_data(self, params, universe=None):
+        ''' Fetches the factor scores of the whole filtered universe into universe_data.'''
+        if universe is None and not (self.local_scoring and self.local_filters):
+            universe = self.create_universe(params)
+        return self.set_universe_data(self.fetch_universe_data(universe, params), params)
+
+    def set_universe_data(self, data, params):
+        ''' Keeps the factor scores of the filtered universe of the parameters, for select() and sweep().'''
+        self.universe_data = self.compacted(data)
+        self.universe_key = params.universe_key
+        self.ranking = None
+        return self.universe_data
+
+    def run_score(self, params):
+        self.tracer.start_run()
+        with self.stage('universe'):
+            universe = None if self.local_scoring and self.local_filters else self.create_universe(params)
+        if self.local_scoring or self.incremental:
+            self.load_universe_data(params, universe)
+            return self.select(params)
+
+        data = self.fetch_data(universe, params)
+        # Compute Total Score
+        total_score_factors = self.factors.total_score_factors
+        if len(total_score_factors) > 0:
+            with self.stage('total score'):
+                total_score = data[total_score_factors].multiply(self.weights(params).divide(100)).sum(axis=1).to_frame('Total Score')
+                data = data.join(total_score).sort_values(by='Total Score', ascending=False)
+        return data
+
+    def fetch_ids(self, universe, params):
+        ''' Returns the IDs of the universe.'''
+        return get_single_field_request(
+            connection=self.connection, universe=universe, field=self.connection.data.id(), field_name='ID',
+            with_params=self.with_params(params), store=self.snapshot(params),
+        ).ID.tolist()
+
+    def sweep(self, params, weights, base=0, rank_changes=True):
+        '''
+        Summary:
+            Screens the universe of the parameters with many weight vectors at once (see sweep_total_scores).
+            The factor scores of the universe are fetched once and kept, so further sweeps cost no request.
+        Args:
+            params (ScoringParameters): the universe and the Top/Bottom selection (its weights are not used).
+            weights (DataFrame): one weight vector per row, in percent, one column per factor used in the
+                Total Score (e.g. weight_grid(factors.total_score_factors, step=5)).
+            base (int): the position of the reference scenario for the overlaps and rank changes.
+            rank_changes (bool): if False, the rank changes are not computed.
+        '''
+        with self.lock:
+            if self.universe_data is None or self.universe_key != params.universe_key:
+                self.tracer.start_run()
+                self.load_universe_data(params)
+            weights = weights.reindex(columns=self.factors.total_score_factors).fillna(0.)
+            with self.stage('sweep'):
+                return sweep_total_scores(self.universe_data, weights, params.rank_method, params.rank_num, base=base, rank_changes=rank_changes)
+
+    def fetch_members(self, params):
+        ''' Returns the IDs of the filtered universe.'''
+        return self.fetch_ids(self.create_universe(params), params)
+
+    def score_many(self, params_list):
+        '''
+        Summary:
+            Scores several universes (e.g. indices, or region/sector combinations) with one fetch of the raw values:
+            the members of each universe are retrieved first, then the raw values of all distinct members are
+            requested once per ref_date and currency, and each universe is scored locally on its own members.
+        Args:
+            params_list (list): a list of ScoringParameters (see also expand_parameters).
+        Returns:
+            an OrderedDict of scored DataFrames, mapped by the key of the parameters.
+        '''
+        with self.lock:
+            self.tracer.start_run()
+            members = run_in_parallel([partial(self.fetch_members, params) for params in params_list], max_workers=self.max_workers,
+                                      timeout=self.request_timeout)
+            groups = OrderedDict()
+            for params, ids in zip(params_list, members):
+                groups.setdefault((str(params.ref_date), params.currency), []).append((params, ids))
+
+            results = OrderedDict()
+            for (ref_date, currency), screens in groups.items():
+                params = screens[0][0]
+                all_ids = list(OrderedDict.fromkeys(i for _, ids in screens for i in ids))
+                store = None if self.store is None else self.store.partition(ref_date, 'multi_universe', currency)
+                raw_data = self.fetch_raw_data(params, ids=all_ids, store=store)
+                for params, ids in screens:
+                    results[params.key] = self.compacted(self.select(params, self.factors.compute_local(raw_data.reindex(ids))))
+            return OrderedDict((params.key, results[params.key]) for params in params_list)
+
+    def compacted(self, data):
+        if not self.compact:
+            return data
+        return compact_frame(data, float32=self.float32, pool=self.tickers)
+
+    @property
+    def summary(self):
+        ''' Returns a short description of the cache usage, if the connection is cached.'''
+        if isinstance(self.connection.connection, CachedConnection):
+            return self.connection.connection.cache.summary
+        return None
+
+
+def expand_parameters(params, universes, regions=None, sectors=None):
+    ''' Returns a copy of params for each combination of universe tickers, regions and sectors.'''
+    if regions is None:
+        regions = [params.region]
+    if sectors is None:
+        sectors = [params.sector]
+    return [params.copy(universe_ticker=universe, region=region, sector=sector, name=None)
+            for universe in universes for region in regions for sector in sectors]
+
+
+# Command line
+
+def load_factors(model_path, connection):
+    ''' Imports the Python file model_path and returns its build_factors(connection) (an AllFactors).'''
+    spec = importlib.util.spec_from_file_location('scoring_model', model_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.build_factors(connection)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the equity scoring model for each parameter set of a JSON file and writes one CSV per screen.')
+    parser.add_argument('parameters', help='JSON file with a list of parameter sets (see ScoringParameters).')
+    parser.add_argument('--model', required=True, help='Python file defining build_factors(connection), returning an AllFactors.')
+    parser.add_argument('--output-dir', default='.', help='Folder of the CSV files.')
+    parser.add_argument('--local-scoring', action='store_true', help='Compute the scores locally from the raw values.')
+    parser.add_argument('--batch-requests', action='store_true', help='Send one request per group of compatible factors.')
+    parser.add_argument('--max-workers', type=int, default=None, help='Send the requests concurrently with this many threads.')
+    parser.add_argument('--store', default=None, help='Folder of the on-disk snapshot store of past dates.')
+    parser.add_argument('--trace', default=None, help='JSON file where the timings of all requests are written (Chrome trace format).')
+    parser.add_argument('--chunk-size', type=int, default=None, help='With --local-scoring, request the raw values for this many IDs at a time.')
+    parser.add_argument('--refresh-state', default=None,
+                        help='Folder of the raw inputs of the previous run: only the price-driven fields and the names with new filings are fetched '
+                             '(the scores are computed locally, as with --local-scoring).')
+    parser.add_argument('--record', default=None, help='Folder of an archive where all requests and responses are recorded (see utils_replay).')
+    parser.add_argument('--replay', default=None, help='Folder of a recorded archive: the requests are served from it, without bql.')
+    parser.add_argument('--latency-scale', type=float, default=1., help='With --replay, the factor applied to the recorded durations.')
+    args = parser.parse_args(argv)
+
+    if args.replay is not None:
+        from utils_replay import ReplayConnection
+        connection = ReplayConnection(args.replay, latency_scale=args.latency_scale)
+    else:
+        import bql
+        connection = bql.Service()
+    if args.record is not None:
+        from utils_replay import RecordingConnection
+        connection = RecordingConnection(connection, args.record)
+    connection = CachedConnection(connection)
+    store = None
+    if args.store is not None:
+        from utils_store import SnapshotStore
+        store = SnapshotStore(args.store)
+    # the daily refresh always scores the raw inputs locally (the neutral factors are only allowed with local_scoring)
+    local_scoring = args.local_scoring or args.refresh_state is not None
+    engine = ScoringEngine(
+        factors=load_factors(args.model, connection), connection=connection, local_scoring=local_scoring,
+        max_workers=args.max_workers, batch_requests=args.batch_requests, store=store, chunk_size=args.chunk_size,
+    )
+    refresh = None
+    if args.refresh_state is not None:
+        from daily_refresh import DailyRefresh
+        refresh = DailyRefresh(engine, args.refresh_state)
+    with open(args.parameters) as f:
+        parameter_sets = json.load(f)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for i, values in enumerate(parameter_sets):
+        params = ScoringParameters.from_dict(values)
+        name = params.name if params.name is not None else 'screen_{}'.format(i)
+        data = engine.score(params) if refresh is None else refresh.run(params)
+        data.to_csv(os.path.join(args.output_dir, '{}.csv'.format(name)))
+        print('{}: {} stocks'.format(name, len(data)))
+        if refresh is not None:
+            print('{refetched} of {members} members refetched'.format(**refresh.stats))
+        print(engine.tracer.summary.replace('<br>', '\n'))
+    if args.trace is not None:
+        engine.tracer.save(args.trace)
+
+
+if __name__ == '__main__':
+    main()
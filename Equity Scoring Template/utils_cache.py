@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def request_fingerprint(request):
+    '''
+    Summary:
+        A stable key for a bql.Request: the universe (ticker, dates and filters), the field
+        expressions, the with_params and the preferences.
+    Args:
+        request (bql.Request): the request to be fingerprinted.
+    '''
+    if hasattr(request, 'to_string'):
+        text = request.to_string()
+    else:
+        text = repr((request.universe, list(request.items.items()), sorted(request.with_params.items())))
+    text += repr(sorted(getattr(request, 'preferences', {}).items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+
+    def __init__(self, max_size=128, ttl=None):
+        '''
+        Summary:
+            A thread-safe LRU cache with an optional time to live.
+        Args:
+            max_size (int): the maximum number of entries; the least recently used is evicted first.
+            ttl (float): the number of seconds after which an entry expires. Defaults to never
+                (use a ttl for intraday data).
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        ''' Returns the cached value, or None if missing or expired.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, key):
+        ''' Returns True if the key is cached and not expired, without counting a hit or a miss.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (self.ttl is None or time.monotonic() - entry[0] <= self.ttl)
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        ''' Removes one entry, or all of them if no key is given.'''
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    @property
+    def summary(self):
+        ''' Returns a short description of the cache usage.'''
+        return 'Cache: {h} hits, {m} misses, {n} entries'.format(h=self.hits, m=self.misses, n=len(self))
+
+
+class ConnectionWrapper(object):
+
+    def __init__(self, connection):
+        '''
+        Summary:
+            The base class of the connections wrapping another one (see CachedConnection, TracedConnection,
+            RecordingConnection): univ, data, func, etc. come from the wrapped connection, and the subclasses
+            override execute. A wrapper can be used everywhere a connection is expected.
+        Args:
+            connection (bq connection): the connection to be wrapped.
+        '''
+        self.connection = connection
+
+    def __getattr__(self, name):
+        # univ, data, func, etc. come from the wrapped connection
+        if name == 'connection':
+            raise AttributeError(name)
+        return getattr(self.connection, name)
+
+    def execute(self, request):
+        return self.connection.execute(request)
+
+
+class CachedConnection(ConnectionWrapper):
+
+    def __init__(self, connection, max_size=128, ttl=None, cache=None):
+        '''
+        Summary:
+            Wraps a bql connection so that identical requests are only sent once.
+            It can be used everywhere a connection is expected (e.g. EquityScoringApp).
+        Args:
+            connection (bq connection): a connection to the bql server initialised with bql.Service().
+            max_size (int): the maximum number of cached requests.
+            ttl (float): the number of seconds after which a cached response expires.
+            cache (ResponseCache): an existing cache to be shared; overrides max_size and ttl.
+        '''
+        super().__init__(connection)
+        if cache is None:
+            cache = ResponseCache(max_size=max_size, ttl=ttl)
+        self.cache = cache
+
+    def execute(self, request):
+        key = request_fingerprint(request)
+        responses = self.cache.get(key)
+        if responses is None:
+            responses = self.connection.execute(request)
+            self.cache.set(key, responses)
+        return responses
+
+    def cached(self, request):
+        ''' Returns True if the responses of the request are in the cache.'''
+        return self.cache.contains(request_fingerprint(request))
+
+    def invalidate(self, request=None):
+        ''' Removes the given request from the cache, or all of them if no request is given.'''
+        self.cache.invalidate(None if request is None else request_fingerprint(request))
@@ -1,5 +1,73 @@
-import numpy as np
 from collections import OrderedDict
+from types import MappingProxyType
+
+# numpy, pandas and utils_scoring are only imported by the local scoring methods, so that a model can be
+# defined (and scored by the bql server) without loading them.
+
+
+def expression_key(bql_function):
+    ''' Identifies a BQL expression: two items with the same BQL text are the same expression.
+    Items without a readable text are only identical to themselves.'''
+    text = repr(bql_function)
+    if ' object at 0x' in text:
+        return id(bql_function)
+    return text
+
+
+# The arithmetic of BQL items that is computed locally from its operands (see AllFactors.input_plan)
+LOCAL_OPERATORS = OrderedDict([('add', 'add'), ('sub', 'subtract'), ('mul', 'multiply'), ('div', 'divide')])
+
+
+def split_expression(bql_function):
+    ''' The operator and the two operands of an arithmetic expression of BQL items (e.g. a / b * 100),
+    or None for the other items (fields, functions, items without a readable structure).'''
+    name, args = getattr(bql_function, 'name', None), getattr(bql_function, 'args', None)
+    if not isinstance(name, str) or name not in LOCAL_OPERATORS or not isinstance(args, tuple) or len(args) != 2:
+        return None
+    if len(getattr(bql_function, 'kwargs', None) or {}) > 0:
+        return None
+    # the operands are other items or numbers
+    if any(isinstance(arg, (str, bool)) for arg in args):
+        return None
+    return name, args
+
+
+def expression_leaves(bql_function):
+    ''' The items an expression is computed from locally: the operands of its arithmetic, down to the
+    first item that is not an arithmetic expression. Numbers are not leaves.'''
+    parts = split_expression(bql_function)
+    if parts is None:
+        return [bql_function]
+    return [leaf for arg in parts[1] if not isinstance(arg, (int, float)) for leaf in expression_leaves(arg)]
+
+
+class LocalExpression(object):
+
+    def __init__(self, operator, operands):
+        '''
+        Summary:
+            An arithmetic expression of raw columns, computed locally (e.g. a dividend yield from the dividend and px_last).
+        Args:
+            operator (str): 'add', 'sub', 'mul' or 'div'.
+            operands (list): the two operands, each a column name, a number or a LocalExpression.
+        '''
+        self.operator = operator
+        self.operands = operands
+
+    def evaluate(self, raw_data):
+        ''' The values of the expression for the rows of raw_data. Non-finite results (e.g. a division by zero)
+        are missing values, as for replacenonnumeric, so that they do not spoil the z-scores of the other names.'''
+        import numpy as np
+        values = []
+        for operand in self.operands:
+            if isinstance(operand, LocalExpression):
+                operand = operand.evaluate(raw_data)
+            elif isinstance(operand, str):
+                operand = np.asarray(raw_data[operand].values, dtype=float)
+            values.append(operand)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result = getattr(np, LOCAL_OPERATORS[self.operator])(values[0], values[1])
+        return np.where(np.isfinite(result), result, np.nan)
 
 
 class BQLFunction(object):
@@ -22,7 +90,7 @@ class BQLFunction(object):
         self.bql_function = bql_function
         if sign is None:
             sign = 1.
-        self.sign = np.sign(sign)
+        self.sign = float((sign > 0) - (sign < 0))
         if relative_weight is None:
             relative_weight = 1.
         self.relative_weight = max(relative_weight, 0) # can't be negative
@@ -41,6 +109,9 @@ class BQLFunction(object):
 
 class Factor(object):
     
+    # factors that can only be computed from the raw values (see ScoringEngine local_scoring)
+    local_only = False
+    
     def __init__(self, name, bql_functions=None, skipna_preference=True, use_in_total_score=False):
         ''' 
         Summary:
@@ -57,10 +128,16 @@ class Factor(object):
             self.bql_functions = []
         self.skipna_preference = skipna_preference
         self.use_in_total_score = use_in_total_score
+        self._plan = None
     
     def add_bql_function(self, bql_function):
         ''' Append a BQLFunction element.'''
         self.bql_functions.append(bql_function)
+        self.invalidate()
+    
+    def invalidate(self):
+        ''' Forgets the compiled fields, which are rebuilt on next access.'''
+        self._plan = None
     
     def add_factor(self, name, bql_function, sign=None, relative_weight=None):
         ''' Add a BQLFunction element with given name, bql_function, sign and relative_weight.'''
@@ -82,10 +159,53 @@ class Factor(object):
         ''' Displays all functions listed.'''
         return OrderedDict([bf.summary for bf in self.bql_functions])
     
+    @property
+    def inputs(self):
+        ''' The raw inputs of the factor, as (name, bql_function): the BQLFunctions by default.'''
+        return [bf.summary for bf in self.bql_functions]
+    
+    @property
+    def signs(self):
+        ''' Returns the signs of all BQLFunctions in the object.'''
+        return [bf.sign for bf in self.bql_functions]
+    
+    @property
+    def relative_weights(self):
+        ''' Returns the relative_weights of all BQLFunctions in the object.'''
+        return [bf.relative_weight for bf in self.bql_functions]
+    
+    @property
+    def plan_key(self):
+        ''' Identifies the BQLFunctions and parameters the fields are built from.'''
+        return tuple((bf.name, id(bf.bql_function), bf.sign, bf.relative_weight) for bf in self.bql_functions)
+    
     @property
     def fields(self):
+        ''' The fields built by build_fields, compiled once into a read-only mapping and rebuilt only
+        when the BQLFunctions change. Use a copy (e.g. OrderedDict(factor.fields)) to derive other fields.'''
+        if self._plan is None or self._plan[0] != self.plan_key:
+            self._plan = (self.plan_key, MappingProxyType(self.build_fields()))
+        return self._plan[1]
+    
+    def build_fields(self):
         ''' Method implemented in the subclasses. This is only a general class.'''
-        raise Error("Not implemented yet")
+        raise NotImplementedError("Not implemented yet")
+    
+    def compute_local(self, raw_data, columns=None):
+        ''' Method implemented in the subclasses. Computes 'fields' locally from the raw values
+        of the BQLFunctions (a DataFrame with one column per BQLFunction, given by columns, which
+        defaults to the BQLFunction names).'''
+        raise NotImplementedError("Not implemented yet")
+    
+    def score_frame(self, scores, index):
+        import pandas as pd
+        return pd.DataFrame({self.name: scores}, index=index)
+    
+    def raw_values(self, raw_data, columns=None):
+        ''' Returns the raw values of the BQLFunctions, one column per BQLFunction.'''
+        if columns is None:
+            columns = list(self.original_fields.keys())
+        return raw_data[columns].values
 
 
 class DescriptiveFactor(Factor):
@@ -98,11 +218,18 @@ class DescriptiveFactor(Factor):
     def __init__(self, name, bql_functions=None, skipna_preference=True, use_in_total_score=False):
         super().__init__(name, bql_functions, skipna_preference=skipna_preference, use_in_total_score=use_in_total_score)
     
-    @property
-    def fields(self):
+    def build_fields(self):
         ''' Displays all functions listed.'''
         return self.original_fields
     
+    def compute_local(self, raw_data, columns=None):
+        ''' Returns the raw values of the functions listed.'''
+        if columns is None:
+            columns = list(self.original_fields.keys())
+        data = raw_data[columns].copy()
+        data.columns = list(self.original_fields.keys())
+        return data
+    
 
 class RankedFactor(Factor):
     '''
@@ -114,13 +241,19 @@ class RankedFactor(Factor):
     def __init__(self, name, bql_functions=None, skipna_preference=False, use_in_total_score=True):
         super().__init__(name, bql_functions, skipna_preference=skipna_preference, use_in_total_score=use_in_total_score)
     
-    @property
-    def fields(self):
+    def build_fields(self):
         ''' Displays the weighted average of the rankings.'''
         rankings = [bf.relative_weight * bf.signed_function.group().rank(ties='max').ungroup() for bf in self.bql_functions]
         average = sum(rankings) / self.sum_relative_weights
         return OrderedDict([(self.name, average)])
     
+    def compute_local(self, raw_data, columns=None):
+        ''' Computes the weighted average of the rankings from the raw values.'''
+        from utils_scoring import weighted_rank
+        values = self.raw_values(raw_data, columns)
+        average = weighted_rank(values, self.signs, self.relative_weights)
+        return self.score_frame(average, raw_data.index)
+    
 
 class ZScoreFactor(Factor):
     '''
@@ -134,13 +267,114 @@ class ZScoreFactor(Factor):
         self.fillna_value = fillna_value
     
     @property
-    def fields(self):
+    def plan_key(self):
+        return super().plan_key + (self.fillna_value,)
+    
+    def build_fields(self):
         ''' Displays the weighted average of the zscores of the BQLFunctions.'''
         zscores = [bf.relative_weight * bf.signed_function.groupzscore().replacenonnumeric(self.fillna_value) for bf in self.bql_functions]
         average = sum(zscores) / self.sum_relative_weights
         average = sum(zscores) / (self.sum_squared_relative_weights ** 0.5)
         return OrderedDict([(self.name, average)])
     
+    def compute_local(self, raw_data, columns=None):
+        ''' Computes the weighted average of the zscores from the raw values.'''
+        from utils_scoring import weighted_zscore
+        values = self.raw_values(raw_data, columns)
+        average = weighted_zscore(values, self.signs, self.relative_weights, self.fillna_value)
+        return self.score_frame(average, raw_data.index)
+    
+
+class NeutralZScoreFactor(ZScoreFactor):
+    '''
+    Inherits from ZScoreFactor: the z-scores are computed within groups (e.g. GICS sectors or countries)
+    instead of the whole universe, after an optional winsorisation of the values within their group.
+    The group labels are an extra raw input, fetched once whatever the number of neutral factors using them.
+    The scores are computed locally only (see ScoringEngine local_scoring).
+    '''
+    
+    local_only = True
+    
+    def __init__(self, name, group_by, group_name='Group', bql_functions=None, winsorize=None, fillna_value=-3, skipna_preference=True,
+                 use_in_total_score=True):
+        '''
+        Args:
+            group_by (BQL item): the group labels, e.g. bq.data.gics_sector_name() or bq.data.country_full_name().
+            group_name (str): the name of the group labels in the raw data.
+            winsorize (tuple): the (lower, upper) quantiles the values are clipped to within their group, e.g. (0.01, 0.99).
+        '''
+        super().__init__(name, bql_functions, fillna_value=fillna_value, skipna_preference=skipna_preference, use_in_total_score=use_in_total_score)
+        self.group_by = group_by
+        self.group_name = group_name
+        self.winsorize = winsorize
+    
+    @property
+    def inputs(self):
+        return super().inputs + [(self.group_name, self.group_by)]
+    
+    @property
+    def plan_key(self):
+        return super().plan_key + (id(self.group_by), self.winsorize)
+    
+    def build_fields(self):
+        ''' The BQL equivalent of the scores grouped by group_by, without winsorisation (not requested by the engine).'''
+        zscores = [bf.relative_weight * bf.signed_function.group(self.group_by).zscore().ungroup().replacenonnumeric(self.fillna_value)
+                   for bf in self.bql_functions]
+        return OrderedDict([(self.name, sum(zscores) / (self.sum_squared_relative_weights ** 0.5))])
+    
+    def compute_local(self, raw_data, columns=None):
+        ''' Computes the weighted average of the z-scores within groups from the raw values.'''
+        from utils_scoring import neutral_zscore
+        if columns is None:
+            columns = [name for name, bql_function in self.inputs]
+        values = self.raw_values(raw_data, columns[:-1])
+        average = neutral_zscore(values, raw_data[columns[-1]].values, self.signs, self.relative_weights, self.fillna_value, self.winsorize)
+        return self.score_frame(average, raw_data.index)
+    
+
+class NeutralRankedFactor(RankedFactor):
+    '''
+    Inherits from RankedFactor: the functions are ranked within groups (e.g. GICS sectors or countries)
+    instead of the whole universe, after an optional winsorisation of the values within their group.
+    The scores are computed locally only (see ScoringEngine local_scoring).
+    '''
+    
+    local_only = True
+    
+    def __init__(self, name, group_by, group_name='Group', bql_functions=None, winsorize=None, skipna_preference=False, use_in_total_score=True):
+        '''
+        Args:
+            group_by (BQL item): the group labels, e.g. bq.data.gics_sector_name() or bq.data.country_full_name().
+            group_name (str): the name of the group labels in the raw data.
+            winsorize (tuple): the (lower, upper) quantiles the values are clipped to within their group, e.g. (0.01, 0.99).
+        '''
+        super().__init__(name, bql_functions, skipna_preference=skipna_preference, use_in_total_score=use_in_total_score)
+        self.group_by = group_by
+        self.group_name = group_name
+        self.winsorize = winsorize
+    
+    @property
+    def inputs(self):
+        return super().inputs + [(self.group_name, self.group_by)]
+    
+    @property
+    def plan_key(self):
+        return super().plan_key + (id(self.group_by), self.winsorize)
+    
+    def build_fields(self):
+        ''' The BQL equivalent of the ranks grouped by group_by, without winsorisation (not requested by the engine).'''
+        rankings = [bf.relative_weight * bf.signed_function.group(self.group_by).rank(ties='max').ungroup() for bf in self.bql_functions]
+        return OrderedDict([(self.name, sum(rankings) / self.sum_relative_weights)])
+    
+    def compute_local(self, raw_data, columns=None):
+        ''' Computes the weighted average of the rankings within groups from the raw values.'''
+        from utils_scoring import neutral_rank
+        if columns is None:
+            columns = [name for name, bql_function in self.inputs]
+        values = self.raw_values(raw_data, columns[:-1])
+        average = neutral_rank(values, raw_data[columns[-1]].values, self.signs, self.relative_weights, self.winsorize)
+        return self.score_frame(average, raw_data.index)
+    
 
 class AllFactors(object):
     
@@ -165,3 +399,96 @@ class AllFactors(object):
     def total_score_factors(self):
         return [factor.name for factor in self.factors if factor.use_in_total_score==True]
     
+    @property
+    def input_plan(self):
+        '''
+        Summary:
+            Finds the distinct raw inputs of all factors: identical expressions used by several BQLFunctions
+            are fetched only once. An arithmetic expression (e.g. a dividend / px_last * 100) whose operands are
+            shared with other inputs (the same field, the same value of a symbol translation, px_last, etc.) is
+            not fetched: each operand is fetched once in its own column and the expression is computed locally.
+            Inputs of factors used in the Total Score are kept apart from the others, as they are
+            requested as of the ref date.
+        Returns:
+            an OrderedDict of the inputs (column name -> (factor, bql_function)), an OrderedDict of the inputs
+            computed locally (column name -> LocalExpression) and, for each factor, the list of the columns of its inputs.
+        '''
+        distinct = OrderedDict()
+        for factor in self.factors:
+            for name, bql_function in factor.inputs:
+                distinct.setdefault((expression_key(bql_function), factor.use_in_total_score), (factor, name, bql_function))
+        # the number of distinct inputs each operand is used by
+        users = {}
+        for (key, in_total_score), (factor, name, bql_function) in distinct.items():
+            for leaf_key in set((expression_key(leaf), in_total_score) for leaf in expression_leaves(bql_function)):
+                users[leaf_key] = users.get(leaf_key, 0) + 1
+
+        inputs, derived = OrderedDict(), OrderedDict()
+        columns_by_key = {}
+
+        def add_column(key, name):
+            column, i = name, 2
+            while column in inputs or column in derived:
+                column, i = '{} ({})'.format(name, i), i + 1
+            columns_by_key[key] = column
+            return column
+
+        def local_expression(factor, bql_function, in_total_score):
+            parts = split_expression(bql_function)
+            if parts is None:
+                key = (expression_key(bql_function), in_total_score)
+                if key not in columns_by_key:
+                    leaf_name = getattr(bql_function, 'name', None)
+                    inputs[add_column(key, leaf_name if isinstance(leaf_name, str) else 'Input')] = (factor, bql_function)
+                return columns_by_key[key]
+            operands = [arg if isinstance(arg, (int, float)) else local_expression(factor, arg, in_total_score) for arg in parts[1]]
+            return LocalExpression(parts[0], operands)
+
+        for key, (factor, name, bql_function) in distinct.items():
+            if key in columns_by_key:
+                continue
+            shared = any(users[(expression_key(leaf), key[1])] > 1 for leaf in expression_leaves(bql_function))
+            if split_expression(bql_function) is not None and shared:
+                expression = local_expression(factor, bql_function, key[1])
+                derived[add_column(key, name)] = expression
+            else:
+                inputs[add_column(key, name)] = (factor, bql_function)
+        columns = [[columns_by_key[(expression_key(bql_function), factor.use_in_total_score)] for name, bql_function in factor.inputs]
+                   for factor in self.factors]
+        return inputs, derived, columns
+    
+    def raw_fields(self, ref_date=None, all_factors=False):
+        '''
+        Summary:
+            Returns the distinct raw inputs of all factors (see input_plan), mapped by column name.
+        Args:
+            ref_date (str): if given, the inputs of the factors used in the Total Score are requested as of this date.
+            all_factors (bool): if True, the inputs of all factors are requested as of the ref_date.
+        '''
+        inputs, derived, columns = self.input_plan
+        fields = OrderedDict()
+        for column, (factor, bql_function) in inputs.items():
+            if ref_date is not None and (all_factors or factor.use_in_total_score):
+                bql_function = bql_function.as_of(ref_date)
+            fields[column] = bql_function
+        return fields
+    
+    def compute_local(self, raw_data, weights=None):
+        '''
+        Summary:
+            Computes the fields of all factors locally from the raw values and, if weights
+            are given, adds the Total Score.
+        Args:
+            raw_data (DataFrame): the raw values, with one column per input (see raw_fields).
+            weights (Series): the Total Score weights in percent, indexed by factor name.
+        '''
+        import pandas as pd
+        from utils_scoring import total_score
+        inputs, derived, columns = self.input_plan
+        if len(derived) > 0:
+            derived_data = pd.DataFrame(OrderedDict((column, expression.evaluate(raw_data)) for column, expression in derived.items()), index=raw_data.index)
+            raw_data = pd.concat([raw_data, derived_data], axis=1)
+        data = pd.concat([factor.compute_local(raw_data, factor_columns) for factor, factor_columns in zip(self.factors, columns)], axis=1)
+        if weights is not None and len(self.total_score_factors) > 0:
+            data = data.join(total_score(data, weights))
+        return data
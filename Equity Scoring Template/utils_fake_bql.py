@@ -0,0 +1,310 @@
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# A stand-in for the bql module that returns synthetic data with artificial delays.
+# It makes it possible to run and time the scoring code without a Bloomberg backend:
+#
+#     import utils_fake_bql
+#     utils_fake_bql.install()   # before importing utils_general / equity_scoring
+#     bq = utils_fake_bql.Service(latency=0.5)
+
+SECTORS = [
+    'Communication Services', 'Consumer Discretionary', 'Consumer Staples', 'Energy', 'Financials',
+    'Health Care', 'Industrials', 'Information Technology', 'Materials', 'Real Estate', 'Utilities'
+]
+
+COUNTRIES = [
+    'AUSTRIA', 'BELGIUM', 'BRITAIN', 'DENMARK', 'FINLAND', 'FRANCE', 'GERMANY', 'IRELAND', 'ITALY',
+    'NETHERLANDS', 'NORWAY', 'PORTUGAL', 'SPAIN', 'SWEDEN', 'SWITZERLAND', 'UNITED STATES'
+]
+
+STRING_FIELDS = {
+    'id': None,
+    'name': None,
+    'gics_sector_name': SECTORS,
+    'icb_sector_name': SECTORS,
+    'country_full_name': COUNTRIES,
+}
+
+
+def stable_seed(text):
+    ''' A seed that does not change between sessions (unlike hash()).'''
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def format_argument(arg):
+    if isinstance(arg, str):
+        return "'{}'".format(arg)
+    if isinstance(arg, (list, tuple)):
+        return '[{}]'.format(', '.join(format_argument(a) for a in arg))
+    return repr(arg)
+
+
+class Item(object):
+
+    def __init__(self, name, args=(), kwargs=None, namespace='func'):
+        '''
+        Summary:
+            A symbolic BQL item. Methods and operators return new items, so that
+            expressions can be chained as with the real BQL object model.
+        Args:
+            name (str): the name of the BQL function or data item.
+            args (tuple): the positional arguments (other items or values).
+            kwargs (dict): the keyword arguments.
+            namespace (str): 'data', 'func' or 'univ'.
+        '''
+        self.name = name
+        self.args = tuple(args)
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.namespace = namespace
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: Item(name, (self,) + args, kwargs)
+
+    def __repr__(self):
+        args = [format_argument(a) for a in self.args]
+        args += ['{}={}'.format(k, format_argument(v)) for k, v in sorted(self.kwargs.items())]
+        return '{}({})'.format(self.name, ', '.join(args))
+
+    def __add__(self, other):
+        return Item('add', (self, other))
+
+    def __radd__(self, other):
+        return Item('add', (other, self))
+
+    def __sub__(self, other):
+        return Item('sub', (self, other))
+
+    def __rsub__(self, other):
+        return Item('sub', (other, self))
+
+    def __mul__(self, other):
+        return Item('mul', (self, other))
+
+    def __rmul__(self, other):
+        return Item('mul', (other, self))
+
+    def __truediv__(self, other):
+        return Item('div', (self, other))
+
+    def __rtruediv__(self, other):
+        return Item('div', (other, self))
+
+    def __neg__(self):
+        return Item('mul', (-1, self))
+
+    def __lt__(self, other):
+        return Item('lt', (self, other))
+
+    def __le__(self, other):
+        return Item('le', (self, other))
+
+    def __gt__(self, other):
+        return Item('gt', (self, other))
+
+    def __ge__(self, other):
+        return Item('ge', (self, other))
+
+
+class Namespace(object):
+    ''' bq.data, bq.func and bq.univ: every attribute is a function returning an Item.'''
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: Item(name, args, kwargs, namespace=self.namespace)
+
+
+class Request(object):
+
+    def __init__(self, universe, items, with_params=None, preferences=None):
+        ''' Same signature as bql.Request; items is a dict of named items or a single item.'''
+        self.universe = universe
+        if not isinstance(items, dict):
+            items = OrderedDict([(repr(items), items)])
+        self.items = items
+        self.with_params = with_params if with_params is not None else {}
+        self.preferences = preferences if preferences is not None else {}
+
+
+class Response(object):
+
+    def __init__(self, name, df):
+        self.name = name
+        self._df = df
+
+    def df(self):
+        return self._df
+
+
+def combined_df(responses):
+    return pd.concat([response.df()[[response.name]] for response in responses], axis=1)
+
+
+class Service(object):
+
+    def __init__(self, universe_size=600, latency=0., latency_per_row=0., nan_ratio=0.05, universe_sizes=None):
+        '''
+        Summary:
+            A fake bql.Service returning deterministic synthetic data.
+            The same security always gets the same value for the same expression, whatever the universe.
+        Args:
+            universe_size (int): the number of members of any index.
+            latency (float): seconds slept by every execute call.
+            latency_per_row (float): additional seconds slept per row and field returned.
+            nan_ratio (float): the share of missing numeric values.
+            universe_sizes (dict): number of members of specific indices (e.g. {'SX5E Index': 50}).
+        '''
+        self.data = Namespace('data')
+        self.func = Namespace('func')
+        self.univ = Namespace('univ')
+        self.universe_size = universe_size
+        self.universe_sizes = universe_sizes if universe_sizes is not None else {}
+        self.latency = latency
+        self.latency_per_row = latency_per_row
+        self.nan_ratio = nan_ratio
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.request_count = 0
+        self.row_count = 0
+        self.bytes_moved = 0
+
+    # Universe
+
+    def members(self, ticker, dates=None):
+        size = self.universe_sizes.get(ticker, self.universe_size)
+        ids = ['S{:05d} Equity'.format(i) for i in range(size)]
+        if dates is not None:
+            # drop a few names depending on the date, to simulate index changes
+            ids = [i for i in ids if stable_seed(str(dates) + i) % 100 >= 3]
+        return ids
+
+    def evaluate_universe(self, universe):
+        if isinstance(universe, (list, tuple)):
+            return list(universe)
+        if isinstance(universe, str):
+            return self.members(universe)
+        if universe.name == 'members':
+            tickers = universe.args[0] if isinstance(universe.args[0], (list, tuple)) else [universe.args[0]]
+            ids = OrderedDict()
+            for ticker in tickers:
+                ids.update((i, None) for i in self.members(ticker, universe.kwargs.get('dates')))
+            return list(ids)
+        if universe.name == 'list':
+            return list(universe.args[0])
+        if universe.name == 'filter':
+            ids = self.evaluate_universe(universe.args[0])
+            mask = self.evaluate(universe.args[1], ids)
+            return [i for i, keep in zip(ids, mask) if keep is True or keep == 1]
+        return self.evaluate_universe(universe.args[0])
+
+    # Items
+
+    def leaf(self, item, ids, context):
+        choices = STRING_FIELDS.get(item.name.lower(), False)
+        if item.name.lower() == 'id':
+            return np.array(ids, dtype=object)
+        if len(ids) == 0:
+            return np.array([], dtype=float)
+        positions = np.array([int(i[1:6]) if i[1:6].isdigit() else stable_seed(i) % 100000 for i in ids], dtype=int)
+        seed = stable_seed(repr(item) + context)
+        if choices is None:
+            return np.array(['Company {}'.format(p) for p in positions], dtype=object)
+        if choices:
+            codes = np.random.RandomState(stable_seed(item.name.lower()) % (2 ** 32)).randint(len(choices), size=positions.max() + 1)
+            return np.array(choices, dtype=object)[codes[positions]]
+        # separate generators for the values and the missing ones, so that a security gets the same value whatever the universe
+        values = np.random.RandomState(seed % (2 ** 32)).normal(loc=1., scale=1., size=positions.max() + 1)
+        values[np.random.RandomState((seed + 1) % (2 ** 32)).uniform(size=positions.max() + 1) < self.nan_ratio] = np.nan
+        if item.name.lower() in ('market_cap', 'cur_mkt_cap'):
+            values = np.exp(values + 21.)
+        elif item.name.lower() == 'px_last':
+            values = np.exp(values + 3.)
+        return values[positions]
+
+    def evaluate(self, item, ids, context=''):
+        if not isinstance(item, Item):
+            return item
+        if item.namespace == 'data':
+            return self.leaf(item, ids, context)
+        name = item.name.lower()
+        if name == 'as_of':
+            return self.evaluate(item.args[0], ids, context + repr(item.args[1]))
+        if name == 'matches':
+            values = self.evaluate(item.args[0], ids, context)
+            mask = np.asarray(self.evaluate(item.args[1], ids, context), dtype=bool)
+            return np.where(mask, values, np.nan)
+        if name == 'in_':
+            values = self.evaluate(item.args[0], ids, context)
+            return np.isin(values, list(item.args[1]))
+        args = [self.evaluate(a, ids, context) for a in item.args]
+        if name in ('add', 'sub', 'mul', 'div', 'lt', 'le', 'gt', 'ge'):
+            a, b = (np.asarray(x, dtype=float) if not np.isscalar(x) else x for x in args)
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                result = {'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.divide,
+                          'lt': np.less, 'le': np.less_equal, 'gt': np.greater, 'ge': np.greater_equal}[name](a, b)
+            if name in ('lt', 'le', 'gt', 'ge'):
+                return result
+            # a division by zero gives a missing value, as in the local scoring (see LocalExpression)
+            return np.where(np.isfinite(result), result, np.nan)
+        if name == 'between':
+            values = np.asarray(args[0], dtype=float)
+            return (values >= args[1]) & (values <= args[2])
+        if name == 'groupzscore':
+            values = pd.Series(np.asarray(args[0], dtype=float))
+            return ((values - values.mean()) / values.std()).values
+        if name in ('rank', 'grouprank'):
+            return pd.Series(np.asarray(args[0], dtype=float)).rank(method='max', ascending=False).values
+        if name in ('replacenonnumeric', 'znav'):
+            fill = args[1] if len(args) > 1 else 0.
+            return pd.Series(np.asarray(args[0], dtype=float)).fillna(fill).values
+        if name == 'pct_chg':
+            values = np.asarray(args[0], dtype=float)
+            return values / np.nanmedian(values) - 1.
+        if name == 'toupper':
+            return np.array([str(v).upper() for v in args[0]], dtype=object)
+        # group, ungroup, value, translatesymbols, etc. leave the values unchanged
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                return arg
+        return np.full(len(ids), np.nan)
+
+    # Execution
+
+    def execute(self, request):
+        ids = self.evaluate_universe(request.universe)
+        responses = []
+        for name, item in request.items.items():
+            values = self.evaluate(item, ids)
+            df = pd.DataFrame({name: values}, index=pd.Index(ids, name='ID'))
+            if request.preferences.get('SkipNa', False):
+                df = df.dropna()
+            responses.append(Response(name, df))
+        rows = sum(len(response.df()) for response in responses)
+        with self.lock:
+            self.request_count += 1
+            self.row_count += rows
+            self.bytes_moved += sum(int(response.df().memory_usage(deep=True).sum()) for response in responses)
+        time.sleep(self.latency + self.latency_per_row * rows)
+        return responses
+
+
+def install(force=False):
+    ''' Registers this module as 'bql', so that the scoring modules run against the fake service.'''
+    if force or 'bql' not in sys.modules:
+        sys.modules['bql'] = sys.modules[__name__]
+    return sys.modules['bql']
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+# Compact storage of the scored DataFrames, for large universes and multi-date panels: text columns
+# (names, sectors, countries) become categoricals, scores can be kept as float32, and the tickers are
+# stored once, whatever the number of frames they appear in.
+
+class TickerPool(object):
+
+    def __init__(self):
+        '''
+        Summary:
+            Interns the tickers (and names) of the frames: each string is stored once, and frames with the same
+            tickers in the same order share one Index object.
+        '''
+        self.tickers = {}
+        self.last_index = None
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def intern(self, values):
+        ''' Returns the values with each distinct string replaced by its first occurrence.'''
+        return [self.tickers.setdefault(value, value) for value in values]
+
+    def index(self, index):
+        ''' Returns the shared Index equal to index, or a new Index of interned tickers.'''
+        if isinstance(index, pd.MultiIndex) or index.dtype != object:
+            return index
+        if self.last_index is not None and self.last_index.name == index.name and self.last_index.equals(index):
+            return self.last_index
+        self.last_index = pd.Index(self.intern(index), dtype=object, name=index.name)
+        return self.last_index
+
+
+def is_text(values):
+    return values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty')
+
+
+def compact_frame(data, float32=False, pool=None):
+    '''
+    Summary:
+        Returns a copy of the data with the text columns repeated across rows (sectors, countries) as categoricals
+        (each distinct text stored once, plus an integer code per row), the other text columns (names) interned in
+        the pool if given, and, if float32 is True, the float columns as float32 (about 7 significant digits, enough for scores).
+        Object columns holding numbers are converted to floats.
+    Args:
+        data (DataFrame): a scored DataFrame, indexed by ID.
+        float32 (bool): if True, the floats are stored in single precision.
+        pool (TickerPool): if given, the index and the names are interned in the pool.
+    '''
+    columns = OrderedDict()
+    for column in data.columns:
+        values = data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.remove_unused_categories()
+        elif is_text(values) and values.nunique() <= len(values) / 2:
+            values = values.astype('category')
+        elif is_text(values) and pool is not None:
+            values = pd.Series(pool.intern(values.values), index=values.index, dtype=object)
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ('floating', 'integer', 'mixed-integer-float'):
+            values = values.astype(float)
+        if float32 and pd.api.types.is_float_dtype(values.dtype):
+            values = values.astype(np.float32)
+        columns[column] = values.values
+    index = data.index if pool is None else pool.index(data.index)
+    return pd.DataFrame(columns, index=index, columns=data.columns)
+
+
+def concat_frames(frames, names=('date', 'ID'), float32=False):
+    '''
+    Summary:
+        Stacks the scored DataFrames of several dates into one frame indexed by (date, ID). The dates and the
+        tickers of the index, and the text columns, are dictionary encoded: the values are stored once and
+        each row only holds integer codes.
+    Args:
+        frames (OrderedDict): the scored DataFrames (with the same columns), mapped by date.
+        names (tuple): the names of the levels of the index.
+        float32 (bool): if True, the floats are stored in single precision.
+    '''
+    frames = OrderedDict((date, frame) for date, frame in frames.items() if len(frame) > 0)
+    if len(frames) == 0:
+        return pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=list(names)))
+    columns = list(frames.values())[0].columns
+    codes = np.repeat(np.arange(len(frames)), [len(frame) for frame in frames.values()])
+    dates = pd.Categorical.from_codes(codes, categories=[str(date) for date in frames.keys()])
+    tickers = union_categoricals([pd.Categorical(frame.index.values) for frame in frames.values()])
+    data = OrderedDict()
+    for column in columns:
+        parts = [frame[column] for frame in frames.values()]
+        if all(is_text(part) or isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            data[column] = union_categoricals([pd.Categorical(part.values) for part in parts])
+        else:
+            values = np.concatenate([np.asarray(part.values, dtype=float) for part in parts])
+            data[column] = values.astype(np.float32) if float32 else values
+    index = pd.MultiIndex.from_arrays([dates, tickers], names=list(names))
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def memory_usage(data):
+    ''' The bytes used by the index and by each column of the data (text included), and their total.'''
+    usage = data.memory_usage(index=True, deep=True)
+    usage = OrderedDict((str(name), int(size)) for name, size in usage.items())
+    usage['Total'] = sum(usage.values())
+    return usage
+
+
+def format_memory(size):
+    if size < 1000:
+        return '{} B'.format(size)
+    for unit in ['kB', 'MB', 'GB']:
+        size /= 1000.
+        if size < 1000 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+
+
+def memory_summary(data):
+    ''' A short description of the size of the data, e.g. for the ApplicationLogger.'''
+    usage = memory_usage(data)
+    total = usage.pop('Total')
+    largest = sorted(usage.items(), key=lambda item: -item[1])[:3]
+    return 'Result: {:,} rows x {} columns, {} ({})'.format(
+        len(data), len(data.columns), format_memory(total), ', '.join('{} {}'.format(name, format_memory(size)) for name, size in largest))
@@ -1,6 +1,13 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+from functools import partial
+
+import numpy as np
 import pandas as pd
 
-import bql
+from utils_cache import request_fingerprint
+from utils_factors import expression_key
 
 
 # Override Parameters
@@ -15,8 +22,23 @@ sntm = {'FPT':'BT', 'FPO':'2'}
 trail12m = {'FPO':'0', 'FPT':'LTM'}
 
 
+REGIONS_MAPPING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regions_mapping.csv')
+
+
 # Functions
 
+def new_request(universe, items, with_params=None, preferences=None):
+    ''' Returns a bql.Request. bql is only imported here, on the first request, so that the module (and the scoring
+    engine) can be imported without it, e.g. by batch jobs that only define or score factors.'''
+    import bql
+    return bql.Request(universe, items, with_params=with_params, preferences=preferences)
+
+
+def load_regions(path=REGIONS_MAPPING_PATH):
+    ''' Returns the countries of each region of the csv file (one column per region), with 'All' mapped to None.'''
+    return OrderedDict([('All', None)] + [(name, df.dropna().values.tolist()) for name, df in pd.read_csv(path).items()])
+
+
 def format_floats(val):
     try:
         return int(val*100)/100.
@@ -24,20 +46,282 @@ def format_floats(val):
         return val
 
 
+def run_in_parallel(tasks, max_workers=None, timeout=None):
+    '''
+    Summary:
+        Runs the tasks (functions without arguments, e.g. requests) concurrently in a thread pool
+        and returns their results in the original order.
+    Args:
+        tasks (list): the functions to be called.
+        max_workers (int): the maximum number of concurrent tasks. Defaults to one thread per task.
+        timeout (float): the maximum number of seconds to wait for all results. Defaults to no limit.
+            Once it is reached, a TimeoutError is raised at once: the tasks not started are cancelled,
+            and the running ones are left to finish in the background.
+    '''
+    if len(tasks) == 0:
+        return []
+    if max_workers is None:
+        max_workers = len(tasks)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(task) for task in tasks]
+    try:
+        # one deadline for all the tasks, and the first failure is raised without waiting for the others
+        done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future in done and future.exception() is not None:
+                raise future.exception()
+        if len(not_done) > 0:
+            raise FuturesTimeoutError('{} of {} tasks not finished after {}s'.format(len(not_done), len(futures), timeout))
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def execute_request(connection, request, store=None):
+    ''' Executes the request, unless its responses are already in the store (a SnapshotPartition).'''
+    if store is None:
+        return connection.execute(request)
+    key = request_fingerprint(request)
+    responses = store.load(key)
+    if responses is None:
+        responses = connection.execute(request)
+        store.save(key, responses)
+    return responses
+
+
 def group_rank_ties(bq_connection, field, ties='max', null_value=0):
     f = bq_connection.func
     return f.replacenonnumeric(f.ungroup(f.rank(f.group(field), ties='MAX')), null_value)
 
 
-def get_score_data(connection, universe, fields, with_params=None, preferences=None):
+def responses_to_df(responses, fields, aliases=None):
+    ''' Builds a DataFrame with the responses of the given fields, in the order of the fields.
+    aliases maps the name of a field to the name of the response it was fetched with.'''
+    if aliases is None:
+        aliases = {}
+    series = {response.name: response.df()[response.name] for response in responses}
+    return pd.DataFrame({f: series[aliases.get(f, f)] for f in fields.keys()})[[f for f in fields.keys()]]
+
+
+def get_score_data(connection, universe, fields, with_params=None, preferences=None, store=None):
     if with_params is None:
         with_params = {}
     if preferences is None:
         preferences = {}
-    request = bql.Request(universe, fields, with_params=with_params, preferences=preferences)
-    responses = connection.execute(request)
-    df = pd.DataFrame({response.name: response.df()[response.name] for response in responses})[[f for f in fields.keys()]]
-    return df.applymap(format_floats)
+    request = new_request(universe, OrderedDict(fields), with_params=with_params, preferences=preferences)
+    responses = execute_request(connection, request, store)
+    return responses_to_df(responses, fields)
+
+
+def plan_requests(fields_list, preferences_list, batch=True):
+    '''
+    Summary:
+        Groups the fields of several factors into as few requests as possible. Factors can share
+        a request if they have the same preferences and no field name in common.
+    Args:
+        fields_list (list): the fields (OrderedDict) of each factor.
+        preferences_list (list): the preferences (dict) of each factor.
+        batch (bool): if False, each factor gets its own request.
+    Returns:
+        a list of (preferences, positions) tuples, positions being the indices of the factors in the request.
+    '''
+    batches = []
+    for position, (fields, preferences) in enumerate(zip(fields_list, preferences_list)):
+        for batch_preferences, positions in batches if batch else []:
+            names = set(name for p in positions for name in fields_list[p].keys())
+            if batch_preferences == preferences and names.isdisjoint(fields.keys()):
+                positions.append(position)
+                break
+        else:
+            batches.append((preferences, [position]))
+    return batches
+
+
+def get_batched_score_data(connection, universe, fields_list, with_params=None, preferences_list=None, batch=True, max_workers=None, timeout=None, store=None):
+    '''
+    Summary:
+        Retrieves the fields of several factors with one request per group of compatible factors
+        (see plan_requests) and splits the responses back per factor.
+    Args:
+        connection (bq connection): a connection to the bql server.
+        universe (BQL universe): the universe shared by all factors.
+        fields_list (list): the fields (OrderedDict) of each factor.
+        with_params (dict): the with_params shared by all factors.
+        preferences_list (list): the preferences (dict) of each factor.
+        batch (bool): if False, each factor gets its own request.
+        max_workers (int): if given, the requests are sent concurrently (see run_in_parallel).
+        timeout (float): the maximum number of seconds to wait for all the concurrent requests.
+        store (SnapshotPartition): if given, the responses are read from/written to the snapshot store.
+    Returns:
+        a list with the DataFrame of each factor, in the order of fields_list.
+    '''
+    if with_params is None:
+        with_params = {}
+    if preferences_list is None:
+        preferences_list = [{} for fields in fields_list]
+    batches = plan_requests(fields_list, preferences_list, batch=batch)
+    requests = []
+    aliases_list = []
+    for preferences, positions in batches:
+        # identical expressions of the batch are requested once, under the name of the first one
+        fields = OrderedDict()
+        names_by_key = {}
+        aliases = {}
+        for p in positions:
+            for name, field in fields_list[p].items():
+                key = expression_key(field)
+                if key not in names_by_key:
+                    names_by_key[key] = name
+                    fields[name] = field
+                aliases[name] = names_by_key[key]
+        requests.append(new_request(universe, fields, with_params=with_params, preferences=preferences))
+        aliases_list.append(aliases)
+    tasks = [partial(execute_request, connection, request, store) for request in requests]
+    if max_workers is None:
+        responses_list = [task() for task in tasks]
+    else:
+        responses_list = run_in_parallel(tasks, max_workers=max_workers, timeout=timeout)
+    data = [None] * len(fields_list)
+    for (preferences, positions), aliases, responses in zip(batches, aliases_list, responses_list):
+        for p in positions:
+            data[p] = responses_to_df(responses, fields_list[p], aliases)
+    return data
+
+
+def get_raw_data(connection, universe, fields, with_params=None, store=None):
+    ''' Returns the raw values of the fields for the whole universe, without SkipNa nor formatting,
+    to be scored locally (see Factor.compute_local).'''
+    if with_params is None:
+        with_params = {}
+    request = new_request(universe, OrderedDict(fields), with_params=with_params, preferences={'SkipNa': False})
+    responses = execute_request(connection, request, store)
+    return pd.DataFrame({response.name: response.df()[response.name] for response in responses})[[f for f in fields.keys()]]
+
+
+def chunk_rows(fields, max_memory):
+    ''' The number of rows of a chunk whose responses fit in max_memory bytes (8 bytes per value).'''
+    return max(1, int(max_memory // (8 * max(len(fields), 1))))
+
+
+def get_chunked_raw_data(connection, ids, fields, with_params=None, chunk_size=None, max_memory=None, store=None):
+    '''
+    Summary:
+        Same as get_raw_data for a list of IDs, requested chunk by chunk for very large universes.
+        The values of each chunk are copied into one preallocated array per field, so that only the
+        responses of one chunk and the final columns are in memory at the same time.
+        The cross-sectional statistics (z-scores, ranks) are computed afterwards on all IDs (see
+        AllFactors.compute_local), so the scores are the same as with a single request.
+    Args:
+        connection (bq connection): a connection to the bql server.
+        ids (list): the IDs of the universe.
+        fields (OrderedDict): the raw fields (see AllFactors.raw_fields).
+        with_params (dict): the with_params of the requests.
+        chunk_size (int): the number of IDs per request.
+        max_memory (int): if chunk_size is not given, the size in bytes of the responses of one chunk.
+            Defaults to a single chunk.
+        store (SnapshotPartition): if given, the responses of each chunk are read from/written to the snapshot store.
+    '''
+    if chunk_size is None:
+        chunk_size = len(ids) if max_memory is None else chunk_rows(fields, max_memory)
+    chunk_size = max(int(chunk_size), 1)
+    index = pd.Index(ids, name='ID')
+    columns = OrderedDict((f, None) for f in fields.keys())
+    for start in range(0, len(index), chunk_size):
+        chunk = index[start:start + chunk_size]
+        chunk_data = get_raw_data(connection, connection.univ.list(chunk.tolist()), fields, with_params=with_params, store=store)
+        positions = start + chunk.get_indexer(chunk_data.index)
+        found = positions >= start
+        for f in fields.keys():
+            values = chunk_data[f].values
+            if columns[f] is None:
+                columns[f] = np.full(len(index), np.nan) if values.dtype.kind in 'biuf' else np.full(len(index), None, dtype=object)
+            elif columns[f].dtype.kind == 'f' and values.dtype.kind not in 'biuf':
+                columns[f] = columns[f].astype(object)
+            columns[f][positions[found]] = values[found]
+        del chunk_data
+    return pd.DataFrame(
+        OrderedDict((f, values if values is not None else np.full(len(index), np.nan)) for f, values in columns.items()),
+        index=index)
+
+
+def create_universe(connection, universe_ticker, ref_date, min_mktcap=0, max_mktcap=10000000, sector='All', countries=None, point_in_time=False):
+    '''
+    Summary:
+        The members of the universe at the ref_date, filtered by market cap (in millions), sector and countries.
+    Args:
+        connection (bq connection): a connection to the bql server.
+        universe_ticker (str): the ticker of the index, e.g. 'SX5E Index'.
+        ref_date (str): the date of the members.
+        min_mktcap (int): the minimum market cap in millions.
+        max_mktcap (int): the maximum market cap in millions.
+        sector (str): a GICS sector name, or 'All'.
+        countries (list): the upper case country names to be kept, or None for all.
+        point_in_time (bool): if True, the filters use the values as of the ref_date (e.g. for backtests).
+    '''
+    def as_of(field):
+        return field.as_of(ref_date) if point_in_time else field
+    
+    universe = connection.univ.members([universe_ticker], dates=ref_date)
+    filter_mktcap = connection.func.between(
+        as_of(connection.data.MARKET_CAP())/1000000, int(min_mktcap), int(max_mktcap))
+    universe = connection.univ.filter(universe, filter_mktcap)
+    
+    if sector != 'All':
+        filter_sector = connection.func.in_(as_of(connection.data.GICS_SECTOR_NAME()), [sector])
+        universe = connection.univ.filter(universe, filter_sector)
+    if countries is not None:
+        filter_countries = connection.func.in_(as_of(connection.data.COUNTRY_FULL_NAME()).toupper(), countries)
+        universe = connection.univ.filter(universe, filter_countries)
+    return universe
+
+
+class UniverseSnapshot(object):
+    
+    def __init__(self, data):
+        '''
+        Summary:
+            The members of a universe with the attributes used by the filters of create_universe, kept in memory
+            so that the filters can be applied locally: market caps are sorted once, sectors and countries are
+            stored as integer codes.
+        Args:
+            data (DataFrame): indexed by ID, with columns MARKET_CAP (in millions), GICS_SECTOR_NAME and
+                COUNTRY_FULL_NAME (upper case).
+        '''
+        self.ids = data.index.values
+        mktcap = data['MARKET_CAP'].values.astype(float)
+        self.mktcap_order = np.argsort(mktcap, kind='mergesort')
+        self.sorted_mktcap = mktcap[self.mktcap_order]
+        self.sectors = pd.Categorical(data['GICS_SECTOR_NAME'])
+        self.countries = pd.Categorical(data['COUNTRY_FULL_NAME'])
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    @classmethod
+    def fetch(cls, connection, universe_ticker, ref_date, with_params=None, store=None):
+        ''' Retrieves the members of the universe at the ref_date, with their market cap, sector and country.'''
+        fields = OrderedDict([
+            ('MARKET_CAP', connection.data.MARKET_CAP()/1000000),
+            ('GICS_SECTOR_NAME', connection.data.GICS_SECTOR_NAME()),
+            ('COUNTRY_FULL_NAME', connection.data.COUNTRY_FULL_NAME().toupper()),
+        ])
+        universe = connection.univ.members([universe_ticker], dates=ref_date)
+        return cls(get_score_data(connection, universe, fields, with_params=with_params, preferences={'SkipNa': False}, store=store))
+    
+    def filter(self, min_mktcap=0, max_mktcap=10000000, sector='All', countries=None):
+        ''' Returns the IDs kept by the same filters as create_universe, in the original order.'''
+        mask = np.zeros(len(self.ids), dtype=bool)
+        first = np.searchsorted(self.sorted_mktcap, int(min_mktcap), side='left')
+        last = np.searchsorted(self.sorted_mktcap, int(max_mktcap), side='right')
+        mask[self.mktcap_order[first:last]] = True
+        # codes of -1 are missing values, and categories not found are -1 too: they are never kept
+        if sector != 'All':
+            codes = self.sectors.categories.get_indexer([sector])
+            mask &= np.isin(self.sectors.codes, codes[codes >= 0])
+        if countries is not None:
+            codes = self.countries.categories.get_indexer(countries)
+            mask &= np.isin(self.countries.codes, codes[codes >= 0])
+        return self.ids[mask].tolist()
 
 
 def get_fundamental_data(bq_connection, field):
@@ -46,12 +330,12 @@ def get_fundamental_data(bq_connection, field):
     return f.value(field, u.translatesymbols(TARGETIDTYPE='FUNDAMENTALTICKER'), MAPBY='LINEAGE')
 
 
-def get_single_field_request(connection, universe, field, field_name, with_params=None, preferences=None):
+def get_single_field_request(connection, universe, field, field_name, with_params=None, preferences=None, store=None):
     if with_params is None:
         with_params = {}
     if preferences is None:
         preferences = {}
-    request = bql.Request(universe, {field_name: field}, with_params=with_params, preferences=preferences)
-    responses = connection.execute(request)
+    request = new_request(universe, {field_name: field}, with_params=with_params, preferences=preferences)
+    responses = execute_request(connection, request, store)
     return responses[0].df()
         
\ No newline at end of file
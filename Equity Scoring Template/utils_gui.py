@@ -1,10 +1,13 @@
 from collections import deque, OrderedDict
 from ipywidgets import HTML, Layout, Dropdown, Button, VBox, HBox, BoundedFloatText, BoundedIntText, Label, Text
+import numpy as np
 import pandas as pd
 
 from bqwidgets import DataGrid
 from bqwidgets import DatePicker
 
+from utils_general import load_regions
+
 
 DEFAULT_WAITING_MSG = HTML(
     value="""<p>Updating. Please Wait...</p>
@@ -15,8 +18,43 @@ DEFAULT_INITIALISATION_MSG = HTML(value='<p>Click on the "Update" button to run
     layout=Layout(margin='25px 0 10px 5px'))
 
 
+class ProgressMessage(HTML):
+    
+    def __init__(self):
+        ''' The waiting message, with the progress of the computations.'''
+        super().__init__(layout=Layout(margin='25px 0 10px 5px'))
+        self.update('')
+    
+    def update(self, message):
+        self.value = """<p>Updating. Please Wait... {msg}</p>
+    <i class="fa fa-spinner fa-spin fa-2x fa-fw" style="color:white;"></i>""".format(msg=message)
+
+
 # Grid
 
+def format_display_data(data, decimals=2):
+    '''
+    Summary:
+        Truncates the floats of the data to the given number of decimals, column by column,
+        for display only (the computations are done at full precision).
+        Text columns, or columns mixing text and numbers, are left unchanged (categoricals are shown as text).
+    Args:
+        data (DataFrame): the data to be displayed.
+        decimals (int): the number of decimals to be kept.
+    '''
+    factor = 10. ** decimals
+    data = data.copy()
+    for column in data.columns:
+        values = data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            data[column] = values = values.astype(object)
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ('floating', 'integer', 'mixed-integer-float'):
+            values = values.astype(float)
+        if pd.api.types.is_float_dtype(values.dtype):
+            data[column] = np.trunc(values.values * factor) / factor
+    return data
+
+
 class Grid(object):
     ''' The class automatically closes Datagrid when reloaded
     and additionally display the Datagrid in a box. '''
@@ -43,11 +81,78 @@ class ScreeningDataGrid(DataGrid):
     ''' The Table where all the computations are shown.'''
     
     # Define the output table column definitions
-    def __init__(self, data, col_defs):
+    def __init__(self, data, col_defs, page_size=100):
+        '''
+        Summary:
+            The grid only receives one page of page_size rows at a time (see pager for the page buttons),
+            and the page is only sent to the front end when its content changed.
+        Args:
+            data (DataFrame): the initial data.
+            col_defs (list): the column definitions of the grid (the Ticker column is added first).
+            page_size (int): the number of rows per page, or None for a single page.
+        '''
         col_defs = [{'width': 150, 'filter': 'text',   'field': 'Ticker', 'headerName': 'Ticker', 'pinned': 'left', 'headerStyle': {'text-align': 'center'}}] + col_defs
         #            [{'width': len(field)*7+45, 'filter': 'number', 'field': field, 'headerName': field, 'headerStyle': {'text-align': 'center'}} for field in fields]
         # grid_options = {'rowSelection': 'single', 'enableColResize': True, 'enableFilter': True, 'enableSorting': True}
         super().__init__(data=data, column_defs=col_defs, layout=Layout(flex='1', height='300px', margin='10px 0 10px 0'))
+        self.page_size = page_size
+        self.page = 0
+        self.full_data = data
+        self.shown_data = None
+        self.pager = GridPager(self)
+    
+    @property
+    def page_count(self):
+        if self.page_size is None:
+            return 1
+        return max(1, -(-len(self.full_data) // self.page_size))
+    
+    def set_data(self, data, decimals=2):
+        '''
+        Summary:
+            Displays the data, with floats truncated to the given number of decimals. The current page is kept.
+        Returns:
+            True if the displayed page changed (and was sent to the front end).
+        '''
+        self.full_data = format_display_data(data, decimals).reset_index(drop=True)
+        return self.show_page(min(self.page, self.page_count - 1))
+    
+    def show_page(self, page):
+        ''' Displays the given page (starting at 0), if it differs from the one displayed.'''
+        self.page = max(0, min(page, self.page_count - 1))
+        if self.page_size is None:
+            page_data = self.full_data
+        else:
+            page_data = self.full_data.iloc[self.page * self.page_size:(self.page + 1) * self.page_size]
+        changed = self.shown_data is None or not page_data.equals(self.shown_data)
+        if changed:
+            self.data = page_data
+        self.shown_data = page_data
+        self.pager.update()
+        return changed
+
+
+class GridPager(HBox):
+    
+    def __init__(self, grid):
+        ''' The previous/next page buttons of a ScreeningDataGrid, with the rows displayed.'''
+        self.grid = grid
+        self.previous = Button(description='<', layout=Layout(width='40px'))
+        self.next = Button(description='>', layout=Layout(width='40px'))
+        self.label = Label(layout=Layout(margin='0 10px 0 10px'))
+        self.previous.on_click(lambda button: self.grid.show_page(self.grid.page - 1))
+        self.next.on_click(lambda button: self.grid.show_page(self.grid.page + 1))
+        super().__init__(children=[self.previous, self.label, self.next])
+        self.update()
+    
+    def update(self):
+        rows = len(self.grid.full_data)
+        first = 0 if self.grid.page_size is None else self.grid.page * self.grid.page_size
+        last = rows if self.grid.page_size is None else min(rows, first + self.grid.page_size)
+        self.label.value = 'Rows {}-{} of {}'.format(min(first + 1, rows), last, rows)
+        self.previous.disabled = self.grid.page == 0
+        self.next.disabled = self.grid.page >= self.grid.page_count - 1
+        self.layout.display = 'none' if self.grid.page_count <= 1 else 'flex'
         
         
 # Buttons
@@ -198,7 +303,7 @@ class ParameterSelection(VBox):
             'Health Care', 'Industrials', 'Information Technology', 'Materials', 'Real Estate', 'Utilities'
         ]
         
-        self.regions = OrderedDict([('All', None)] + [(name, df.dropna().values.tolist()) for name, df in pd.read_csv('regions_mapping.csv').items()])
+        self.regions = load_regions()
         # Elements
         self.universe = TextBoxAndLabel(label='Universe', value='SX5E Index', width=120)
         self.as_of_date = DatePickerAndLabel(label='Ref Date', width=120)
@@ -228,6 +333,11 @@ class ParameterSelection(VBox):
         ]
         
         super().__init__(children=children, layout=Layout(margin='0 0 10px 0'))
+    
+    def on_change(self, handler):
+        ''' Calls handler(change) whenever one of the parameters is changed.'''
+        for widget in [self.universe.text, self.as_of_date.dp, self.region.dd, self.sector.dd, self.currency.dd, self.min_mktcap.bi, self.max_mktcap.bi]:
+            widget.observe(handler, names='value')
 
 
 # Weights
@@ -256,6 +366,11 @@ class WeightsBox(VBox):
     def weights(self):
         return pd.Series({name: box.float_text.value for name,box in self.boxes.items()})
     
+    def on_change(self, handler):
+        ''' Calls handler(change) whenever a weight is changed.'''
+        for box in self.boxes.values():
+            box.float_text.observe(handler, names='value')
+    
     def sum_100(self):
         total_weights = self.weights.sum()
         ratio = self.max_value / total_weights
@@ -275,6 +390,11 @@ class TotalScoreFilter(HBox):
         self.num_stocks = DropdownAndLabel(label='Num. Stocks', options=[10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 150, 300], value=50, width=120)
         
         super().__init__(children=[self.top_bottom, self.num_stocks], layout=Layout(margin='20px 0 0 0'))
+    
+    def on_change(self, handler):
+        ''' Calls handler(change) whenever Top/Bottom or the number of stocks is changed.'''
+        self.top_bottom.dd.observe(handler, names='value')
+        self.num_stocks.dd.observe(handler, names='value')
             
             
 # Title
@@ -0,0 +1,159 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from utils_cache import ConnectionWrapper, request_fingerprint
+from utils_store import SnapshotPartition
+
+
+# Recording of the requests of a session, to replay them offline (without a Bloomberg session) with the same
+# data and the same delays, e.g. to profile a slow screen on a plain Linux box:
+#
+#     connection = RecordingConnection(bql.Service(), 'slow_screen')    # in BQuant
+#     app = EquityScoringApp(factors, col_defs, connection, title='...')
+#
+#     connection = ReplayConnection('slow_screen', latency_scale=1.)    # anywhere
+#
+# An archive is a folder with one parquet file per response (see SnapshotPartition) and requests.jsonl,
+# which lists the requests in the order they were sent, with their fingerprint, field names, arguments and duration.
+# pyarrow is required.
+
+INDEX_FILE = 'requests.jsonl'
+
+
+def request_names(request):
+    ''' The names of the fields of a request (the names of its responses).'''
+    return list(getattr(request, 'items', {}).keys())
+
+
+def request_arguments(request):
+    '''
+    Summary:
+        The quoted texts and the numbers of the universe and of the fields of a request (tickers, dates, IDs,
+        market cap bounds, etc.), sorted. Unlike the fingerprint, they do not depend on how the BQL objects are
+        written, so that they tell apart the requests with the same field names of bql and of utils_fake_bql.
+    Args:
+        request (bql.Request): the request.
+    '''
+    text = repr((getattr(request, 'universe', None), list(getattr(request, 'items', {}).values())))
+    quoted = re.findall(r"'([^']*)'|\"([^\"]*)\"", text)
+    arguments = [single or double for single, double in quoted]
+    unquoted = re.sub(r"'[^']*'|\"[^\"]*\"", ' ', text)
+    arguments += [repr(float(number)) for number in re.findall(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])', unquoted)]
+    return sorted(arguments)
+
+
+class RecordingConnection(ConnectionWrapper):
+
+    def __init__(self, connection, path, file_format='parquet'):
+        '''
+        Summary:
+            Wraps a bql connection so that every request is written to an archive with its responses and
+            its duration. It can be used everywhere a connection is expected (e.g. EquityScoringApp).
+            Requests already in the archive are recorded again (with their new duration) but stored once.
+        Args:
+            connection (bq connection): a connection to the bql server initialised with bql.Service().
+            path (str): the folder of the archive; it is created if needed, and extended if it exists.
+            file_format (str): 'parquet' (compressed) or 'arrow' (faster to read).
+        '''
+        super().__init__(connection)
+        self.path = path
+        self.responses = SnapshotPartition(path, file_format=file_format)
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def execute(self, request):
+        start = time.perf_counter()
+        responses = self.connection.execute(request)
+        duration = time.perf_counter() - start
+        key = request_fingerprint(request)
+        entry = OrderedDict([
+            ('fingerprint', key), ('names', [response.name for response in responses]),
+            ('arguments', request_arguments(request)), ('duration', duration),
+            ('rows', max([len(response.df()) for response in responses] + [0])),
+        ])
+        with self.lock:
+            if not self.responses.contains(key):
+                self.responses.save(key, responses)
+            # responses that cannot be written (e.g. columns mixing types) are listed but not replayed
+            entry['stored'] = self.responses.contains(key)
+            with open(os.path.join(self.path, INDEX_FILE), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        return responses
+
+
+class ReplayConnection(ConnectionWrapper):
+
+    def __init__(self, path, latency_scale=1., connection=None, file_format='parquet'):
+        '''
+        Summary:
+            Serves the requests of an archive written by RecordingConnection, after the recorded duration times
+            latency_scale. A request is matched on its fingerprint or, if bql is not installed (the requests are then
+            built by utils_fake_bql and their fingerprints differ), on its field names and its arguments (see
+            request_arguments). A KeyError is raised if no recorded request, or several different ones, match.
+        Args:
+            path (str): the folder of the archive.
+            latency_scale (float): the factor applied to the recorded durations; 0 serves the responses immediately.
+            connection (bq connection): the connection providing data, func and univ to build the requests. Defaults
+                to bql.Service(), or to the fake service of utils_fake_bql if bql is not installed.
+            file_format (str): the format the archive was written with.
+        '''
+        if connection is None:
+            connection = default_connection()
+        super().__init__(connection)
+        self.path = path
+        self.latency_scale = latency_scale
+        self.responses = SnapshotPartition(path, file_format=file_format, writable=False)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.by_names = {}
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            for line in f:
+                entry = json.loads(line)
+                if not entry['stored']:
+                    continue
+                self.entries.setdefault(entry['fingerprint'], entry)
+                self.by_names.setdefault(tuple(entry['names']), OrderedDict()).setdefault(entry['fingerprint'], entry)
+        self.request_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, request):
+        ''' The recorded entry of the request. Raises a KeyError if the request was not recorded, or if several
+        recorded requests with other fingerprints have the same field names and arguments.'''
+        with self.lock:
+            self.request_count += 1
+        entry = self.entries.get(request_fingerprint(request))
+        if entry is not None:
+            return entry
+        names = request_names(request)
+        arguments = request_arguments(request)
+        # the entries of archives written before the arguments were recorded are only matched on the names
+        candidates = [entry for entry in self.by_names.get(tuple(names), {}).values() if entry.get('arguments', arguments) == arguments]
+        if len(candidates) == 0:
+            raise KeyError('Request not recorded in {}: {}'.format(self.path, ', '.join(names)))
+        if len(candidates) > 1:
+            raise KeyError('{} recorded requests in {} match the request: {}'.format(len(candidates), self.path, ', '.join(names)))
+        return candidates[0]
+
+    def execute(self, request):
+        entry = self.find(request)
+        start = time.perf_counter()
+        responses = self.responses.load(entry['fingerprint'])
+        delay = entry['duration'] * self.latency_scale - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+        return responses
+
+
+def default_connection():
+    try:
+        import bql
+    except ImportError:
+        import utils_fake_bql
+        bql = utils_fake_bql.install()
+    return bql.Service()
@@ -0,0 +1,396 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# Local scoring engine
+# The functions below reproduce the BQL scoring expressions built by the Factor classes
+# (groupzscore, group().rank(ties='max'), replacenonnumeric) on raw values held in memory,
+# so that weights and signs can be changed without a new request to the server.
+
+def as_2d(values):
+    ''' Returns the values as a 2D float array (one column per function).'''
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    return values
+
+
+def zscore(values, ddof=1):
+    '''
+    Summary:
+        Column-wise z-score ignoring NaNs and infinite values (which get NaN), equivalent to BQL groupzscore().
+    Args:
+        values (array): a 1D or 2D array; each column is scored separately.
+        ddof (int): delta degrees of freedom of the standard deviation. Defaults to 1.
+    '''
+    values = as_2d(values)
+    valid = np.isfinite(values)
+    count = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(valid, values, 0.).sum(axis=0) / count
+        deviations = np.where(valid, values - mean, 0.)
+        std = np.sqrt((deviations ** 2).sum(axis=0) / (count - ddof))
+        return np.where(valid, (values - mean) / std, np.nan)
+
+
+def rank_max(values, ascending=False):
+    '''
+    Summary:
+        Column-wise rank with ties='max', equivalent to BQL group().rank(ties='max').ungroup().
+        NaNs are not ranked and stay NaN.
+    Args:
+        values (array): a 1D or 2D array; each column is ranked separately.
+        ascending (bool): if False (default) the largest value has rank 1, as in grouprank.
+    '''
+    values = as_2d(values)
+    ranks = np.full(values.shape, np.nan)
+    for col in range(values.shape[1]):
+        column = values[:, col]
+        valid = ~np.isnan(column)
+        ordered = np.sort(column[valid])
+        if ascending:
+            ranks[valid, col] = np.searchsorted(ordered, column[valid], side='right')
+        else:
+            ranks[valid, col] = len(ordered) - np.searchsorted(ordered, column[valid], side='left')
+    return ranks
+
+
+def weighted_zscore(values, signs, relative_weights, fillna_value, ddof=1):
+    ''' Weighted sum of the signed z-scores, normalised by the root of the sum of squared weights.'''
+    scores = zscore(as_2d(values) * np.asarray(signs, dtype=float), ddof=ddof)
+    scores[np.isnan(scores)] = fillna_value
+    weights = np.asarray(relative_weights, dtype=float)
+    return scores.dot(weights) / (weights ** 2).sum() ** 0.5
+
+
+def weighted_rank(values, signs, relative_weights):
+    ''' Weighted average of the signed max-tie ranks. A missing input gives a missing average.'''
+    ranks = rank_max(as_2d(values) * np.asarray(signs, dtype=float))
+    weights = np.asarray(relative_weights, dtype=float)
+    return ranks.dot(weights) / weights.sum()
+
+
+
+# Grouped (sector/country-neutral) scoring
+# Each (group, column) pair is a segment with its own integer id, so that the statistics of all groups
+# and columns are computed at once with np.bincount and one sort, without any loop over the groups.
+
+def group_codes(labels):
+    ''' Returns the integer codes of the group labels (-1 for missing labels) and the number of groups.'''
+    codes, groups = pd.factorize(np.asarray(labels, dtype=object))
+    return codes, len(groups)
+
+
+def segments(values, codes, group_count):
+    ''' The valid values (not NaN, with a group) of a 2D array, their segment ids and the number of segments.'''
+    valid = ~np.isnan(values) & (codes >= 0)[:, None]
+    segment_ids = codes[:, None] + group_count * np.arange(values.shape[1])[None, :]
+    return valid, segment_ids[valid], group_count * values.shape[1]
+
+
+def sorted_segments(segment_ids, values):
+    ''' The order sorting the values by segment then value, with the sorted segment ids and values.'''
+    order = np.lexsort((values, segment_ids))
+    return order, segment_ids[order], values[order]
+
+
+def group_zscore(values, codes, group_count, ddof=1):
+    '''
+    Summary:
+        Column-wise z-score within each group, ignoring NaNs (the sector/country-neutral groupzscore()).
+        Names without a group get NaN.
+    Args:
+        values (array): a 1D or 2D array; each column is scored separately.
+        codes (array): the group code of each row (see group_codes).
+        group_count (int): the number of groups.
+        ddof (int): delta degrees of freedom of the standard deviation. Defaults to 1.
+    '''
+    values = as_2d(values)
+    valid, segment_ids, size = segments(values, codes, group_count)
+    x = values[valid]
+    count = np.bincount(segment_ids, minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(segment_ids, weights=x, minlength=size) / count
+        deviations = x - mean[segment_ids]
+        std = np.sqrt(np.bincount(segment_ids, weights=deviations ** 2, minlength=size) / (count - ddof))
+        scores = np.full(values.shape, np.nan)
+        scores[valid] = deviations / std[segment_ids]
+    return scores
+
+
+def group_rank_max(values, codes, group_count, ascending=False):
+    '''
+    Summary:
+        Column-wise rank with ties='max' within each group (the neutral group().rank(ties='max')).
+        NaNs and names without a group are not ranked.
+    Args:
+        values (array): a 1D or 2D array; each column is ranked separately.
+        codes (array): the group code of each row (see group_codes).
+        group_count (int): the number of groups.
+        ascending (bool): if False (default) the largest value of each group has rank 1.
+    '''
+    values = as_2d(values)
+    valid, segment_ids, size = segments(values, codes, group_count)
+    x = values[valid] if ascending else -values[valid]
+    order, sorted_ids, sorted_x = sorted_segments(segment_ids, x)
+    segment_start = np.searchsorted(sorted_ids, sorted_ids, side='left')
+    # runs of equal values within a segment share the rank of the last one
+    new_run = np.ones(len(sorted_x), dtype=bool)
+    new_run[1:] = (sorted_ids[1:] != sorted_ids[:-1]) | (sorted_x[1:] != sorted_x[:-1])
+    run_ids = np.cumsum(new_run)
+    run_end = np.searchsorted(run_ids, run_ids, side='right')
+    ranks = np.empty(len(sorted_x))
+    ranks[order] = run_end - segment_start
+    result = np.full(values.shape, np.nan)
+    result[valid] = ranks
+    return result
+
+
+def group_winsorize(values, codes, group_count, lower=0.01, upper=0.99):
+    '''
+    Summary:
+        Clips the values of each column to the lower and upper quantiles of their group (linear interpolation,
+        as np.quantile). NaNs and names without a group are left unchanged.
+    Args:
+        values (array): a 1D or 2D array.
+        codes (array): the group code of each row (see group_codes); use zeros for a single group.
+        group_count (int): the number of groups.
+        lower (float): the lower quantile, e.g. 0.01.
+        upper (float): the upper quantile, e.g. 0.99.
+    '''
+    values = as_2d(values).copy()
+    valid, segment_ids, size = segments(values, codes, group_count)
+    if not valid.any():
+        return values
+    order, sorted_ids, sorted_x = sorted_segments(segment_ids, values[valid])
+    count = np.bincount(segment_ids, minlength=size)
+    start = np.searchsorted(sorted_ids, np.arange(size), side='left')
+    last = np.maximum(count - 1, 0)
+    bounds = []
+    for quantile in (lower, upper):
+        position = last * quantile
+        below = np.floor(position).astype(int)
+        fraction = position - below
+        low = sorted_x[np.minimum(start + below, len(sorted_x) - 1)]
+        high = sorted_x[np.minimum(start + np.minimum(below + 1, last), len(sorted_x) - 1)]
+        bounds.append(low + (high - low) * fraction)
+    values[valid] = np.clip(values[valid], bounds[0][segment_ids], bounds[1][segment_ids])
+    return values
+
+
+def neutral_zscore(values, groups, signs, relative_weights, fillna_value, winsorize=None, ddof=1):
+    ''' Weighted sum of the signed z-scores within groups, normalised as weighted_zscore.'''
+    codes, group_count = group_codes(groups)
+    # the raw values are winsorised before the signs are applied, so that (lower, upper) clip the low and high raw values
+    values = as_2d(values).astype(float)
+    if winsorize is not None:
+        values = group_winsorize(values, codes, group_count, *winsorize)
+    values = values * np.asarray(signs, dtype=float)
+    scores = group_zscore(values, codes, group_count, ddof=ddof)
+    scores[np.isnan(scores)] = fillna_value
+    weights = np.asarray(relative_weights, dtype=float)
+    return scores.dot(weights) / (weights ** 2).sum() ** 0.5
+
+
+def neutral_rank(values, groups, signs, relative_weights, winsorize=None):
+    ''' Weighted average of the signed max-tie ranks within groups, as weighted_rank.'''
+    codes, group_count = group_codes(groups)
+    # the raw values are winsorised before the signs are applied, so that (lower, upper) clip the low and high raw values
+    values = as_2d(values).astype(float)
+    if winsorize is not None:
+        values = group_winsorize(values, codes, group_count, *winsorize)
+    values = values * np.asarray(signs, dtype=float)
+    ranks = group_rank_max(values, codes, group_count)
+    weights = np.asarray(relative_weights, dtype=float)
+    return ranks.dot(weights) / weights.sum()
+
+def total_score(data, weights):
+    '''
+    Summary:
+        Weighted sum of the factor scores, as done in EquityScoring.update_data.
+    Args:
+        data (DataFrame): the factor scores, one column per factor.
+        weights (Series): the weights in percent, indexed by factor name.
+    '''
+    values = data[weights.index.tolist()].values.astype(float)
+    score = np.nansum(values * weights.divide(100).values, axis=1)
+    return pd.Series(score, index=data.index, name='Total Score')
+
+
+def select_top_bottom(score, rank_method='Top', rank_num=50):
+    '''
+    Summary:
+        Mask of the names kept by the Total Score screen, equivalent to
+        grouprank(total_score) <= rank_num (with the sign flipped for 'Bottom').
+    Args:
+        score (Series): the Total Score.
+        rank_method (str): 'Top' or 'Bottom'.
+        rank_num (int): the number of stocks to keep.
+    '''
+    sign = -1. if rank_method == 'Bottom' else 1.
+    ranks = rank_max(sign * score.values)[:, 0]
+    return pd.Series(ranks <= rank_num, index=score.index)
+
+
+def screen_total_score(data, weights, rank_method='Top', rank_num=50):
+    '''
+    Summary:
+        Adds the Total Score to the factor scores, keeps the top/bottom rank_num names and sorts them
+        by Total Score. Names missing a factor score are not ranked, as in grouprank.
+    Args:
+        data (DataFrame): the factor scores of the whole universe, one column per factor.
+        weights (Series): the weights in percent, indexed by factor name.
+        rank_method (str): 'Top' or 'Bottom'.
+        rank_num (int): the number of stocks to keep.
+    '''
+    data = data.join(total_score(data, weights))
+    complete = data[weights.index.tolist()].notnull().all(axis=1)
+    data = data[select_top_bottom(data['Total Score'].where(complete), rank_method, rank_num)]
+    return data.sort_values(by='Total Score', ascending=False)
+
+
+class ScoreIndex(object):
+
+    def __init__(self, score):
+        '''
+        Summary:
+            The names sorted once by decreasing score, so that the Top/Bottom rank_num names are slices
+            of the sorted index, with the same ties as select_top_bottom (names tied across the cut are left out).
+        Args:
+            score (Series): the Total Score; names with a missing score are not ranked.
+        '''
+        score = score.dropna()
+        values = score.values.astype(float)
+        order = np.argsort(-values, kind='mergesort')
+        self.index = score.index[order]
+        self.values = values[order]
+
+    def __len__(self):
+        return len(self.index)
+
+    def select(self, rank_method='Top', rank_num=50):
+        ''' Returns the names kept by the Top/Bottom rank_num screen, by decreasing score.'''
+        if rank_num >= len(self):
+            return self.index
+        if rank_method == 'Bottom':
+            # the names strictly below the (rank_num + 1)-th lowest score
+            first = np.searchsorted(-self.values, -self.values[-rank_num - 1], side='right')
+            return self.index[first:]
+        # the names strictly above the (rank_num + 1)-th highest score
+        last = np.searchsorted(-self.values, -self.values[rank_num], side='left')
+        return self.index[:last]
+
+
+# Weight scenarios
+# The Total Scores of many weight vectors are computed with one matrix product of the factor scores
+# (names x factors) by the weights (factors x scenarios), and the Top/Bottom names of each scenario
+# are found with a partial sort (np.partition) instead of a full sort.
+
+def weight_grid(factors, step=5, total=100):
+    '''
+    Summary:
+        All the weight vectors on a grid, e.g. the 231 vectors of 3 factors with 5% steps summing to 100%.
+    Args:
+        factors (list): the names of the factors.
+        step (int): the step of the grid, in percent.
+        total (int): the sum of the weights of each vector, in percent.
+    '''
+    def vectors(count, remaining):
+        if count == 1:
+            return [[remaining]]
+        return [[w] + rest for w in range(0, remaining + 1, step) for rest in vectors(count - 1, remaining - w)]
+    return pd.DataFrame(vectors(len(factors), total) if len(factors) > 0 else [], columns=factors, dtype=float)
+
+
+def top_bottom_mask(scores, rank_method='Top', rank_num=50):
+    '''
+    Summary:
+        Column-wise mask of the Top/Bottom rank_num names, with the same ties as select_top_bottom
+        (a name is kept if it is strictly above the (rank_num + 1)-th score).
+    Args:
+        scores (array): a 2D array of Total Scores without NaNs, one column per scenario.
+        rank_method (str): 'Top' or 'Bottom'.
+        rank_num (int): the number of stocks to keep.
+    '''
+    count = scores.shape[0]
+    if rank_num >= count:
+        return np.ones(scores.shape, dtype=bool)
+    if rank_method == 'Bottom':
+        threshold = np.partition(scores, rank_num, axis=0)[rank_num]
+        return scores < threshold
+    threshold = np.partition(scores, count - rank_num - 1, axis=0)[count - rank_num - 1]
+    return scores > threshold
+
+
+def sweep_total_scores(data, weights, rank_method='Top', rank_num=50, base=0, rank_changes=True, block_size=500):
+    '''
+    Summary:
+        Selects the Top/Bottom names of every weight scenario and measures how the selection moves.
+        Only the names with a score for every factor are ranked, as in the screen of the app.
+    Args:
+        data (DataFrame): the factor scores of the universe, one column per factor (e.g. ScoringEngine.universe_data).
+        weights (DataFrame): one weight vector per row (in percent), one column per factor (see weight_grid).
+        rank_method (str): 'Top' or 'Bottom'.
+        rank_num (int): the number of stocks to keep.
+        base (int): the position of the reference scenario for the overlaps and rank changes.
+        rank_changes (bool): if False, the rank changes (which need a full sort of every scenario) are not computed.
+        block_size (int): the number of scenarios scored at a time, to bound the memory used.
+    Returns:
+        an OrderedDict with:
+            membership (DataFrame): True if the name is selected, names x scenarios.
+            stability (Series): the share of scenarios selecting each name, by decreasing value.
+            scenarios (DataFrame): the weights of each scenario, the number of names selected, the overlap
+                with the base scenario (number and share of its names) and the mean and max absolute rank
+                change of the names of the base scenario.
+    '''
+    factors = weights.columns.tolist()
+    scores = data[factors].dropna()
+    values = scores.values.astype(float)
+    matrix = weights.values.astype(float).T / 100.
+    scenarios = matrix.shape[1]
+    membership = np.zeros((len(scores), scenarios), dtype=bool)
+    mean_changes = np.full(scenarios, np.nan)
+    max_changes = np.full(scenarios, np.nan)
+    if scenarios > 0:
+        base_scores = values.dot(matrix[:, [base]])
+        base_members = top_bottom_mask(base_scores, rank_method, rank_num)[:, 0]
+        base_ranks = score_ranks(base_scores, rank_method)[base_members]
+    for start in range(0, scenarios, block_size):
+        stop = min(start + block_size, scenarios)
+        total_scores = values.dot(matrix[:, start:stop])
+        membership[:, start:stop] = top_bottom_mask(total_scores, rank_method, rank_num)
+        if rank_changes and base_members.any():
+            changes = np.abs(score_ranks(total_scores, rank_method)[base_members] - base_ranks)
+            mean_changes[start:stop] = changes.mean(axis=0)
+            max_changes[start:stop] = changes.max(axis=0)
+    selected = membership.sum(axis=0)
+    overlap = membership[base_members].sum(axis=0) if scenarios > 0 else selected
+    summary = weights.copy()
+    summary['Selected'] = selected
+    summary['Overlap'] = overlap
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary['Overlap (%)'] = 100. * overlap / selected[base] if scenarios > 0 else np.nan
+    summary['Mean Rank Change'] = mean_changes
+    summary['Max Rank Change'] = max_changes
+    membership = pd.DataFrame(membership, index=scores.index, columns=weights.index)
+    return OrderedDict([
+        ('membership', membership),
+        ('stability', membership.mean(axis=1).sort_values(ascending=False).rename('Stability')),
+        ('scenarios', summary),
+    ])
+
+
+def score_ranks(scores, rank_method='Top'):
+    ''' Column-wise ordinal ranks (1 for the best Total Score, or the worst one for 'Bottom').'''
+    order = np.argsort(-scores if rank_method != 'Bottom' else scores, axis=0, kind='mergesort')
+    ranks = np.empty(order.shape, dtype=float)
+    np.put_along_axis(ranks, order, np.arange(1, scores.shape[0] + 1, dtype=float)[:, None], axis=0)
+    return ranks
+
+
+def pairwise_overlap(membership):
+    ''' The number of names selected by both scenarios, for every pair of scenarios (one matrix product).'''
+    selected = membership.values.astype(np.int32)
+    return pd.DataFrame(selected.T.dot(selected), index=membership.columns, columns=membership.columns)
@@ -0,0 +1,123 @@
+import datetime
+import json
+import os
+import re
+
+
+# On-disk snapshots of the responses, partitioned by as of date, universe and currency:
+#     <root>/as_of_date=2020-01-31/universe=SX5E_Index/currency=EUR/<request fingerprint>/
+# Only past dates are written by default, as their data does not change any more.
+# pyarrow is required and only imported when a snapshot is read or written.
+
+class StoredResponse(object):
+    ''' A response read from the store, with the same interface as a bql response.'''
+
+    def __init__(self, name, df):
+        self.name = name
+        self._df = df
+
+    def df(self):
+        return self._df
+
+
+def clean_partition_value(value):
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', str(value))
+
+
+class SnapshotStore(object):
+
+    def __init__(self, root, file_format='parquet', persist_today=False):
+        '''
+        Summary:
+            A local columnar store of bql responses.
+        Args:
+            root (str): the folder where the snapshots are written.
+            file_format (str): 'parquet' or 'arrow' (Arrow IPC files, memory-mapped when read).
+            persist_today (bool): if True, also write snapshots for today's (still changing) data.
+        '''
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError("file_format must be 'parquet' or 'arrow'")
+        self.root = root
+        self.file_format = file_format
+        self.persist_today = persist_today
+
+    def partition(self, as_of_date, universe, currency):
+        ''' Returns the SnapshotPartition for the given as of date, universe and currency.'''
+        as_of_date = str(as_of_date)[:10]
+        path = os.path.join(
+            self.root,
+            'as_of_date=' + clean_partition_value(as_of_date),
+            'universe=' + clean_partition_value(universe),
+            'currency=' + clean_partition_value(currency),
+        )
+        writable = self.persist_today or as_of_date < str(datetime.date.today())
+        return SnapshotPartition(path, self.file_format, writable)
+
+
+class SnapshotPartition(object):
+
+    def __init__(self, path, file_format='parquet', writable=True):
+        '''
+        Summary:
+            The snapshots of one as of date, universe and currency. Each request is stored in a folder
+            named after its fingerprint, with one file per response and a manifest of the response names.
+        Args:
+            path (str): the folder of the partition.
+            file_format (str): 'parquet' or 'arrow'.
+            writable (bool): if False, snapshots are read but never written.
+        '''
+        self.path = path
+        self.file_format = file_format
+        self.writable = writable
+
+    def file_path(self, key, position):
+        return os.path.join(self.path, key, '{}.{}'.format(position, self.file_format))
+
+    def read_df(self, path):
+        import pyarrow as pa
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(path, memory_map=True).to_pandas()
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+
+    def write_df(self, df, path):
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df)
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+    def contains(self, key):
+        ''' Returns True if the responses of the request with the given fingerprint are stored.'''
+        return os.path.exists(os.path.join(self.path, key, 'manifest.json'))
+
+    def load(self, key):
+        ''' Returns the stored responses of the request with the given fingerprint, or None.'''
+        if not self.contains(key):
+            return None
+        manifest = os.path.join(self.path, key, 'manifest.json')
+        with open(manifest) as f:
+            names = json.load(f)
+        return [StoredResponse(name, self.read_df(self.file_path(key, i))) for i, name in enumerate(names)]
+
+    def save(self, key, responses):
+        ''' Writes the responses of the request with the given fingerprint. The manifest is written
+        last, so that a partially written snapshot is never read.'''
+        if not self.writable:
+            return
+        os.makedirs(os.path.join(self.path, key), exist_ok=True)
+        try:
+            for i, response in enumerate(responses):
+                self.write_df(response.df(), self.file_path(key, i))
+        except (ValueError, TypeError):
+            # e.g. columns with mixed types that cannot be stored: the request is simply not stored
+            return
+        manifest = os.path.join(self.path, key, 'manifest.json')
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump([response.name for response in responses], f)
+        os.replace(manifest + '.tmp', manifest)
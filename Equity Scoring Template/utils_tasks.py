@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Background execution of the computations of the app, so that the widgets stay responsive:
+# a new run cancels the previous one, and only the result of the latest run is applied.
+
+class CancelledError(Exception):
+    ''' Raised in a run that was cancelled or superseded by a newer one.'''
+
+
+class CancelToken(object):
+
+    def __init__(self):
+        ''' Tells a run whether it has been cancelled. The run checks it between requests (see ScoringEngine.checkpoint).'''
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise CancelledError()
+
+
+class BackgroundRunner(object):
+
+    def __init__(self):
+        '''
+        Summary:
+            Runs one task at a time in a background thread. Submitting a task cancels the task in flight,
+            which stops at its next check of the token; the tasks waiting to start are skipped.
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.token = None
+
+    def submit(self, task, *args, **kwargs):
+        '''
+        Summary:
+            Cancels the current task and schedules task(*args, token=..., **kwargs).
+        Returns:
+            the Future of the task.
+        '''
+        with self.lock:
+            if self.token is not None:
+                self.token.cancel()
+            token = CancelToken()
+            self.token = token
+        return self.executor.submit(self.run, token, task, *args, **kwargs)
+
+    def run(self, token, task, *args, **kwargs):
+        token.check()
+        return task(*args, token=token, **kwargs)
+
+    def is_latest(self, token):
+        ''' Returns True if the token is the one of the last task submitted (its result should be applied).'''
+        with self.lock:
+            return token is self.token and not token.cancelled
+
+    def cancel(self):
+        with self.lock:
+            if self.token is not None:
+                self.token.cancel()
+
+
+class Debouncer(object):
+
+    def __init__(self, function, delay=0.5):
+        '''
+        Summary:
+            Calls function once the calls have stopped for delay seconds, e.g. after the last of several quick edits.
+        Args:
+            function (function): the function to be called, with the arguments of the last call.
+            delay (float): the number of seconds without calls to wait for.
+        '''
+        self.function = function
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.function, args=args, kwargs=kwargs)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+from utils_cache import ConnectionWrapper
+
+
+# Timing of the stages of a screen (universe, screen, factor requests, join, render) and of each request.
+# The events of the last run are summarised for the ApplicationLogger, and all events can be saved as a
+# Chrome trace (open chrome://tracing or https://ui.perfetto.dev and load the JSON file).
+
+class Tracer(object):
+
+    def __init__(self, max_events=10000):
+        '''
+        Summary:
+            Records timed events, grouped by run (e.g. one run per click on Update).
+        Args:
+            max_events (int): the maximum number of events kept; the oldest are dropped first.
+        '''
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.run_id = 0
+
+    def start_run(self):
+        ''' Starts a new run: the summary only describes the events of the last run.'''
+        with self.lock:
+            self.run_id += 1
+
+    @contextmanager
+    def stage(self, name, category='stage', **args):
+        '''
+        Summary:
+            Times the code of the with block. The yielded dict can be updated with details (rows, bytes, etc.).
+        Args:
+            name (str): the name of the stage, e.g. 'screen'.
+            category (str): 'stage' or 'request'.
+            args: details of the stage.
+        '''
+        args = OrderedDict(args)
+        start = time.perf_counter()
+        try:
+            yield args
+        except Exception as error:
+            args['error'] = '{}: {}'.format(type(error).__name__, error)
+            raise
+        finally:
+            self.add(name, start, time.perf_counter() - start, category, args)
+
+    def add(self, name, start, duration, category='stage', args=None):
+        event = OrderedDict([
+            ('name', name), ('category', category), ('run', self.run_id), ('start', start - self.origin), ('duration', duration),
+            ('thread', threading.get_ident()), ('args', args if args is not None else OrderedDict()),
+        ])
+        with self.lock:
+            self.events.append(event)
+
+    def last_run(self):
+        with self.lock:
+            return [event for event in self.events if event['run'] == self.run_id]
+
+    def breakdown(self):
+        ''' The total duration of each stage of the last run, and the duration, rows, bytes and cache hits of each request.'''
+        stages = OrderedDict()
+        requests = OrderedDict()
+        for event in self.last_run():
+            if event['category'] == 'request':
+                totals = requests.setdefault(event['name'], OrderedDict([('duration', 0.), ('rows', 0), ('bytes', 0), ('cache_hits', 0)]))
+                totals['rows'] += event['args'].get('rows', 0)
+                totals['bytes'] += event['args'].get('bytes', 0)
+                totals['cache_hits'] += int(event['args'].get('cache_hit', False))
+            else:
+                totals = stages.setdefault(event['name'], OrderedDict([('duration', 0.)]))
+            totals['duration'] += event['duration']
+        return stages, requests
+
+    @property
+    def summary(self):
+        ''' A compact description of the last run, e.g. for the ApplicationLogger.'''
+        stages, requests = self.breakdown()
+        text = 'Timings: ' + ' | '.join('{} {:.2f}s'.format(name, stage['duration']) for name, stage in stages.items())
+        if len(requests) > 0:
+            text += '<br>Requests: ' + ' | '.join(
+                '{} {:.2f}s, {:,} rows, {:.0f} kB{}'.format(
+                    name, request['duration'], request['rows'], request['bytes'] / 1000., ' (cached)' if request['cache_hits'] > 0 else '')
+                for name, request in requests.items())
+        return text
+
+    def chrome_trace(self):
+        ''' The events in the Chrome trace event format (complete events, times in microseconds).'''
+        with self.lock:
+            events = list(self.events)
+        return OrderedDict([('traceEvents', [
+            OrderedDict([
+                ('name', event['name']), ('cat', event['category']), ('ph', 'X'), ('ts', event['start'] * 1e6),
+                ('dur', event['duration'] * 1e6), ('pid', os.getpid()), ('tid', event['thread']),
+                ('args', dict(event['args'], run=event['run'])),
+            ])
+            for event in events
+        ]), ('displayTimeUnit', 'ms')])
+
+    def save(self, path):
+        ''' Writes the Chrome trace JSON file.'''
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class TracedConnection(ConnectionWrapper):
+
+    def __init__(self, connection, tracer, label=None, before=None, after=None):
+        '''
+        Summary:
+            Wraps a bql connection so that every request is recorded by the tracer, with its duration,
+            the number of rows and bytes of the responses and whether it was served by a CachedConnection.
+        Args:
+            connection (bq connection): the connection to be wrapped (possibly a CachedConnection).
+            tracer (Tracer): the tracer recording the requests.
+            label (function): returns the name of a request from the names of its responses. Defaults to the names joined.
+            before (function): called without arguments before each request (e.g. to stop a cancelled run).
+            after (function): called with the name, the duration and the details of each request once it is done (e.g. to report progress).
+        '''
+        super().__init__(connection)
+        self.tracer = tracer
+        self.label = label
+        self.before = before
+        self.after = after
+
+    def execute(self, request):
+        if self.before is not None:
+            self.before()
+        cache_hit = hasattr(self.connection, 'cached') and self.connection.cached(request)
+        start = time.perf_counter()
+        responses = self.connection.execute(request)
+        frames = [response.df() for response in responses]
+        names = [response.name for response in responses]
+        args = OrderedDict([
+            ('fields', names),
+            ('rows', max([len(df) for df in frames] + [0])),
+            ('bytes', int(sum(df.memory_usage(index=True, deep=False).sum() for df in frames))),
+            ('cache_hit', cache_hit),
+        ])
+        label = self.label(names) if self.label is not None else ', '.join(names)
+        duration = time.perf_counter() - start
+        self.tracer.add(label, start, duration, 'request', args)
+        if self.after is not None:
+            self.after(label, duration, args)
+        return responses